@@ -3,7 +3,18 @@ import json
 import time
 import threading
 import re
-from flask import Flask, request, render_template_string, redirect, url_for, flash, jsonify
+import itertools
+import sqlite3
+import uuid
+import gzip
+import struct
+import hashlib
+import sys
+import atexit
+from datetime import datetime
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, abort, g, request, render_template, render_template_string, redirect, url_for, flash, jsonify
 
 try:
     from openai import OpenAI  # 環境に合わせて利用してください
@@ -34,12 +45,41 @@ DEFAULT_CONFIG = {
         "model": "gemma2",
         "system": "あなたは会話エージェントです。",
         "base_url": "http://localhost:11434/v1",
-        "api_key": "ollama"
+        "api_key": "ollama",
+        # true にすると応答をトークン単位で受け取り、生成途中の投稿を閲覧者へ逐次表示する
+        "stream": False,
+        "STREAM_PUBLISH_INTERVAL": 0.2,
+        # 複数のLLMサーバーへ振り分ける場合に指定 (空なら上の base_url / model の1台だけを使う)
+        # [{"name", "base_url", "api_key", "model", "models": [...], "weight": 1, "max_concurrency": 0}, ...]
+        # エージェントに "model" / "backend" を書くと、そのモデルを持つ / その名前のサーバーだけを使う
+        "backends": [],
+        "FAILURE_THRESHOLD": 3,      # 続けてこの回数失敗したサーバーは切り離す
+        "EJECT_SECONDS": 30,         # 切り離している秒数 (過ぎたら試しに1件流して戻す)
+        "HEALTH_CHECK_INTERVAL": 10  # 切り離し中のサーバーへ /models を問い合わせる間隔 (0 で行わない)
     },
     "conversation": {
         "MAX_CONVERSATION_LENGTH": 100,
         "MAX_DISPLAY_MESSAGES": 50,
-        "CONTEXT_WINDOW": 10
+        "CONTEXT_WINDOW": 10,
+        # 1より大きいと、その人数まで同時に投稿を生成し、エージェント順にコミットする
+        "AGENT_CONCURRENCY": 1,
+        # 生成中に他の投稿が入って文脈が古くなった場合: regenerate / drop / keep
+        "STALE_POLICY": "regenerate",
+        "STALE_TOLERANCE": 0,
+        # true にすると1回のLLM呼び出しでラウンド全員分の投稿を一括生成する (読めなければ1人ずつ生成)
+        "BATCH_TURNS": False,
+        # 一括生成の応答が続けてこの回数読めなければ、BATCH_COOLDOWN 秒は1人ずつ生成する
+        "BATCH_FAILURE_THRESHOLD": 3,
+        "BATCH_COOLDOWN": 300,
+        # 0 より大きいと、CONTEXT_WINDOW の件数ではなくこのトークン数 (概算) に収まるだけ直近の投稿を載せる
+        "CONTEXT_TOKEN_BUDGET": 0,
+        "SUMMARY_TOKEN_SHARE": 0.5,  # 予算のうち、まとめに使ってよい割合 (超える分は切り詰める)
+        # まとめは会話全体をこの件数ずつ区切って要約し、FANOUT 個ずつ畳み込んで作る
+        # SUMMARY_CHUNK_TOKENS > 0 なら件数ではなくトークン数 (概算) で区切る
+        "SUMMARY_CHUNK_SIZE": 50,
+        "SUMMARY_CHUNK_TOKENS": 0,
+        "SUMMARY_FANOUT": 8,
+        "SUMMARY_CONCURRENCY": 4
     },
     # 余計な番号を出力しないように、行頭数字や「<名前>:」は禁止と指示
     "prompt_instructions": (
@@ -50,15 +90,69 @@ DEFAULT_CONFIG = {
         "・数字やコロンから始まる行は書かないでください。\n"
         "システム側で投稿番号を付けます。"
     ),
-    "conversation_log_file": "conversation_log.jsonl"
+    "conversation_log_file": "conversation_log.jsonl",
+    # 追記専用セグメントログ + スナップショットによる会話ストア
+    "conversation_store": {
+        "dir": "conversation_store",
+        "SEGMENT_MAX_RECORDS": 10000,
+        "SEGMENT_MAX_BYTES": 16 * 1024 * 1024,  # このサイズを超えたら次のセグメントへ (0 で無制限)
+        "SEGMENT_MAX_AGE": 0,                   # 最初の投稿からこの秒数で次のセグメントへ (0 で無効)
+        "COMPRESS_SEGMENTS": True,              # 閉じたセグメントをgzipで圧縮する
+        "COMPRESS_BLOCK_RECORDS": 256,          # 圧縮ブロックあたりの件数 (ランダムアクセス時に展開する単位)
+        "SNAPSHOT_INTERVAL": 100,
+        "RETAIN_SEGMENTS": 0
+    },
+    # 会話ストアへの書き込み方
+    "persistence": {
+        "MODE": "async",         # async: 書き込みスレッドでまとめて書く / sync: 投稿したスレッドで1件ずつ書く
+        "BATCH_SIZE": 256,       # 1回の書き込みにまとめる最大件数
+        "FLUSH_INTERVAL": 0.05,  # 最初の投稿からこの秒数だけ後続を待ってまとめる
+        "DURABILITY": "flush"    # flush: OSへ書き出すのみ / fsync_batch: まとめて1回fsync / fsync_message: 1件ごとにfsync
+    },
+    # 全ルームのエージェント投稿を回すスケジューラ
+    "scheduler": {
+        "LLM_SLOTS": 2,          # 同時に実行するLLM呼び出しの上限 (全ルーム合計)
+        "VIEWER_TIMEOUT": 30,    # 最後のアクセスからこの秒数は閲覧中とみなして優先
+        "AGENT_INTERVAL": 1,     # 同じルームでエージェント間に空ける秒数
+        "ROUND_INTERVAL": 5,     # 同じルームで1巡ごとに空ける秒数
+        # adaptive: 上の間隔を投稿の周期とみなし生成時間を差し引く / fixed: 生成後に毎回その秒数待つ
+        "PACING": "adaptive",
+        "MAX_BACKOFF": 60        # LLMエラーが続いたときの最大待ち秒数
+    },
+    # LLM応答のキャッシュ (要約など同じ入力の問い合わせを再送しない。エージェントの投稿には使わない)
+    "llm_cache": {
+        "enabled": True,
+        "MAX_ENTRIES": 256,
+        "TTL": 3600,   # 秒 (0 で無期限)
+        "path": ""     # 指定するとJSONLに保存して再起動後も使う
+    },
+    # 全投稿の検索インデックス (SQLite FTS5)
+    "search_index": {
+        "enabled": True,
+        "path": "history.db"
+    },
+    # /metrics と、リクエストごとの処理時間のログ出力
+    "metrics": {
+        "REQUEST_LOG": False
+    },
+    # 状態の置き場所。"sqlite" にすると複数のワーカープロセスで会話・設定を共有する
+    "state_backend": {
+        "type": "memory",
+        "path": "state.db",
+        "LEASE_SECONDS": 15,     # リーダー (エージェント投稿・要約・ログ書き込み担当) のリース秒数
+        "POLL_INTERVAL": 0.5     # 他プロセスの書き込みを確認する間隔
+    }
 }
 
 config = {}
+config_mtime = None   # 最後に読み込んだ/保存した config.json の更新時刻
+config_version = 0    # 設定が変わるたびに進める (Chatの再構築判定に使用)
 
 def load_config():
-    global config
+    global config, config_mtime, config_version
     if os.path.exists(CONFIG_FILE):
         try:
+            config_mtime = os.path.getmtime(CONFIG_FILE)
             with open(CONFIG_FILE, "r", encoding="utf-8") as f:
                 config = json.load(f)
         except Exception as e:
@@ -67,160 +161,2538 @@ def load_config():
     else:
         config = DEFAULT_CONFIG.copy()
         save_config()
+    config_version += 1
 
 def save_config():
+    global config_mtime
     try:
         with open(CONFIG_FILE, "w", encoding="utf-8") as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
+        config_mtime = os.path.getmtime(CONFIG_FILE)
     except Exception as e:
         print(f"設定ファイルの保存エラー: {e}")
 
+def reload_config_if_changed():
+    """config.json の更新時刻が変わっていれば読み直す (毎ターンのパースを避ける)"""
+    try:
+        mtime = os.path.getmtime(CONFIG_FILE)
+    except OSError:
+        return False
+    if mtime == config_mtime:
+        return False
+    load_config()
+    return True
+
+# --- 計測 (/metrics で公開) ---------------------------------------------------
+
+class Metrics:
+    """
+    Prometheus のテキスト形式で出力できる簡易メトリクス (カウンタ・ヒストグラム・ゲージ)。
+    ラベルはキーワード引数で渡します。ゲージは出力時に関数を呼んで値を集めます。
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}        # name -> (type, help, buckets)
+        self.counters = {}    # (name, labels) -> 値
+        self.histograms = {}  # (name, labels) -> [各バケットの件数..., 合計, 件数]
+        self.gauges = {}      # name -> 値の一覧 [(labels dict, 値), ...] を返す関数
+
+    def counter(self, name, help_text):
+        self.meta[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.meta[name] = ("histogram", help_text, tuple(buckets))
+
+    def gauge(self, name, help_text, collect, kind="gauge"):
+        """出力時に collect() を呼んで値を集める。他で数えている累計値は kind="counter" で公開する"""
+        self.meta[name] = (kind, help_text, None)
+        self.gauges[name] = collect
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            data = self.histograms.get(key)
+            if data is None:
+                data = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def timer(self, name, **labels):
+        """with metrics.timer(...): で囲んだ区間の秒数をヒストグラムに記録する"""
+        metrics = self
+
+        class Timer:
+            def __enter__(self):
+                self.start = time.perf_counter()
+                return self
+
+            def __exit__(self, exc_type, exc, tb):
+                self.elapsed = time.perf_counter() - self.start
+                metrics.observe(name, self.elapsed, **labels)
+        return Timer()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self.meta.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self.gauges:
+                try:
+                    for labels, value in self.gauges[name]():
+                        lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+                except Exception as e:
+                    print(f"メトリクス収集エラー ({name}): {e}")
+            elif kind == "counter":
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+            elif kind == "histogram":
+                for (n, labels), data in sorted(histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(buckets, data):
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {data[-1]}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {data[-2]}")
+                    lines.append(f"{name}_count{self._labels(labels)} {data[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("autochat_llm_request_seconds", "LLM呼び出しの所要時間 (model, kind=agent/summary, backend)")
+metrics.histogram("autochat_llm_prompt_tokens", "LLMに送ったプロンプトのトークン数 (概算)",
+                  buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768))
+metrics.histogram("autochat_llm_response_tokens", "LLM応答のトークン数 (概算)",
+                  buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096))
+metrics.counter("autochat_llm_tokens_total", "LLMとやり取りしたトークン数の累計 (direction=prompt/response)")
+metrics.histogram("autochat_llm_tokens_per_second", "LLM応答の生成速度 (応答トークン数/秒)",
+                  buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+metrics.counter("autochat_llm_errors_total", "LLM呼び出しの失敗数 (type=timeout/error)")
+metrics.histogram("autochat_room_step_seconds", "エージェント投稿1ステップ (1人分、または同時生成・一括生成の1ラウンド) の所要時間")
+metrics.counter("autochat_batch_turns_total", "一括生成のラウンドでの投稿数 (result=parsed: 応答から取り出せた / fallback: 1人ずつ生成)")
+metrics.histogram("autochat_store_seconds", "会話ストアへの書き込み時間 (op=append/snapshot)",
+                  buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+metrics.histogram("autochat_render_seconds", "HTML断片の描画時間 (view)",
+                  buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+metrics.histogram("autochat_http_request_seconds", "HTTPリクエストの処理時間 (endpoint)")
+
 ###############################################################################
 # 2. スレッド固有の設定 (メモリ上)
 ###############################################################################
-# スレッドタイトル・エージェント一覧・まとめテキストなどを管理し、
+# スレッドタイトル・エージェント一覧・まとめテキストなどをルームごとに管理し、
 # エクスポート/インポートでコピー・貼り付けできる形にします。
 
-thread_config = {
-    "title": "未設定",
-    "agents": [],  # [{id, name, personality}, ...]
-    "summary": ""  # 現在のまとめ
-}
-next_agent_id = 1
+DEFAULT_ROOM_ID = "main"
+ROOM_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+class NameMatcher:
+    """
+    返信先として有効な名前 (エージェント + 会話に登場した投稿者) の集合と、その「@名前」正規表現。
+    投稿の追加・削除ごとに参照数を増減し、名前の集合が変わったときだけ正規表現を作り直す。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.message_names = Counter()
+        self.agent_names = frozenset()
+        self._pattern = None
+        self._dirty = True
+
+    def rebuild(self, messages, agents):
+        with self.lock:
+            self.message_names = Counter(m["agent"] for m in messages)
+            self.agent_names = frozenset(a["name"] for a in agents)
+            self._dirty = True
+
+    def add(self, name):
+        with self.lock:
+            self.message_names[name] += 1
+            if self.message_names[name] == 1 and name not in self.agent_names:
+                self._dirty = True
+
+    def remove(self, name):
+        with self.lock:
+            self.message_names[name] -= 1
+            if self.message_names[name] <= 0:
+                del self.message_names[name]
+                if name not in self.agent_names:
+                    self._dirty = True
+
+    def set_agents(self, agents):
+        names = frozenset(a["name"] for a in agents)
+        with self.lock:
+            if names != self.agent_names:
+                self.agent_names = names
+                self._dirty = True
+
+    def pattern(self):
+        with self.lock:
+            if self._dirty:
+                names = self.agent_names | self.message_names.keys()
+                # 長い名前を先に並べ、前方一致する短い名前より優先する
+                alternatives = sorted(names, key=len, reverse=True)
+                self._pattern = re.compile(r'@(' + '|'.join(re.escape(n) for n in alternatives) + r')') if names else None
+                self._dirty = False
+            return self._pattern
+
+    def search(self, text):
+        """本文中の最初の「@名前」の名前を返す"""
+        pattern = self.pattern()
+        if pattern is None:
+            return None
+        match = pattern.search(text)
+        return match.group(1) if match else None
+
+class Message:
+    """
+    メモリ上の会話に置く投稿1件。__slots__ で属性辞書を持たず、投稿者名は intern して共有する。
+    msg["number"] や msg.get("tokens") のように辞書と同じ形でも読める (テンプレート・ログの読み出し結果と混在するため)。
+    JSONへは to_dict で変換する (json.dumps(..., default=Message.to_dict))。
+    """
+    FIELDS = ("number", "agent", "reply_to", "text", "timestamp", "tokens")
+    # html: 描画済みのHTML断片 (投稿は書き込み後に変わらないので1回だけ描画する)
+    __slots__ = FIELDS + ("html",)
+
+    def __init__(self, number, agent, reply_to, text, timestamp, tokens):
+        self.number = number
+        self.agent = sys.intern(agent)
+        self.reply_to = reply_to
+        self.text = text
+        self.timestamp = timestamp
+        self.tokens = tokens
+        self.html = None
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, cls):
+            return data
+        tokens = data.get("tokens")
+        return cls(data["number"], data["agent"], data.get("reply_to"), data["text"],
+                   data.get("timestamp", 0), estimate_tokens(data["text"]) if tokens is None else tokens)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+    def keys(self):
+        return self.FIELDS
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+class MessageRing:
+    """
+    直近 capacity 件の投稿を持つ固定長のリングバッファ (スレッドセーフ)。
+    追加・押し出しは O(1) で、読み出しは必要な末尾の件数分だけをコピーして返す。
+    """
+    def __init__(self, capacity):
+        self.lock = threading.Lock()
+        self.capacity = max(1, int(capacity))
+        self._slots = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return iter(self.tail())
+
+    def append(self, message):
+        """1件追加する。容量を超えて押し出した投稿があれば返す"""
+        with self.lock:
+            index = (self._start + self._size) % self.capacity
+            evicted = self._slots[index] if self._size == self.capacity else None
+            self._slots[index] = message
+            if evicted is None:
+                self._size += 1
+            else:
+                self._start = (self._start + 1) % self.capacity
+            return evicted
+
+    def _tail(self, n):
+        n = self._size if n is None else max(0, min(n, self._size))
+        begin = (self._start + self._size - n) % self.capacity
+        end = begin + n
+        if end <= self.capacity:
+            return self._slots[begin:end]
+        return self._slots[begin:] + self._slots[:end - self.capacity]
+
+    def tail(self, n=None):
+        """古い順に末尾 n 件 (省略時は全件) を返す"""
+        with self.lock:
+            return self._tail(n)
+
+    def last(self):
+        with self.lock:
+            return self._slots[(self._start + self._size - 1) % self.capacity] if self._size else None
+
+    def since(self, number):
+        """投稿番号 number より新しい投稿を古い順に返す (末尾から走査するので差分量に比例)"""
+        with self.lock:
+            count = 0
+            while count < self._size:
+                if self._slots[(self._start + self._size - 1 - count) % self.capacity].number <= number:
+                    break
+                count += 1
+            return self._tail(count)
+
+    def replace(self, messages, capacity=None):
+        """内容を messages (古い順) の末尾で置き換える。capacity を渡すと容量も変える"""
+        messages = [Message.from_dict(m) for m in messages]
+        with self.lock:
+            if capacity is not None:
+                self.capacity = max(1, int(capacity))
+            kept = messages[-self.capacity:]
+            self._slots = kept + [None] * (self.capacity - len(kept))
+            self._start = 0
+            self._size = len(kept)
+
+    def resize(self, capacity):
+        """容量を変える。縮めたときに押し出した投稿を古い順に返す"""
+        capacity = max(1, int(capacity))
+        with self.lock:
+            if capacity == self.capacity:
+                return []
+            messages = self._tail(None)
+            evicted = messages[:-capacity] if len(messages) > capacity else []
+            kept = messages[-capacity:]
+            self.capacity = capacity
+            self._slots = kept + [None] * (capacity - len(kept))
+            self._start = 0
+            self._size = len(kept)
+            return evicted
+
+    def clear(self):
+        with self.lock:
+            self._slots = [None] * self.capacity
+            self._start = 0
+            self._size = 0
+
+class Room:
+    """
+    1つの会話スレッド (ルーム) の状態一式。
+    スレッド設定・会話・ログ・配信・要約ジョブ・スケジューリング情報をルームごとに独立して持ちます。
+    """
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.thread_config = {
+            "title": "未設定",
+            "agents": [],  # [{id, name, personality}, ...]
+            "summary": ""  # 現在のまとめ
+        }
+        self.next_agent_id = 1
+        self.thread_config_version = 0  # タイトル・エージェント・まとめが変わるたびに進める
+        self.name_matcher = NameMatcher()
+        # エージェントID -> (キー, 先頭メッセージ列)。タイトル・まとめ・エージェント・設定が変わると作り直す
+        self.prompt_prefix_cache = {}
+
+        self.message_store = None
+        self.conversation = MessageRing(config["conversation"].get("MAX_CONVERSATION_LENGTH", 100))
+        self.post_counter = 1
+        # 会話の世代。起動時刻で初期化し、クリアのたびに進める (投稿番号の振り直しを区別するため)
+        self.conversation_epoch = int(time.time())
+        self.lock = threading.RLock()
+        self.broadcaster = Broadcaster()
+
+        self.pending_drafts = {}  # (epoch, 投稿番号) -> 置き換える下書きID (共有バックエンド用)
+        self.version = 0          # 共有バックエンド上の設定のバージョン
+
+        self.messages_since_last_summary = 0
+        self.summary_basis = None  # 最後に要約したときの (世代, 投稿番号, タイトル, まとめ)
+        self.summary_chunks = None  # 区切りごとの要約のキャッシュ (SummaryChunkStore)
+        # 確定済みの区切りの要約 (世代, 区切りの設定, [(最初の番号, 最後の番号, 要約), ...])。
+        # 次の要約は最後の区切りの次の投稿から読めばよい
+        self.summary_progress = None
+        self.summary_trigger_lock = threading.Lock()
+        self.summary_job = SummaryJob(lambda: run_with_llm_slot(generate_summary, self))
+
+        # スケジューラが使う情報
+        self.agent_cursor = 0     # 次に発言するエージェントの位置
+        self.next_turn_at = 0.0   # 次のターンを実行してよい時刻
+        self.last_run_at = 0.0    # 最後にターンを実行した時刻 (公平性のため)
+        self.last_viewed = 0.0    # 最後に画面/差分取得でアクセスされた時刻
+        self.running = False
+        self.user_pending = None  # 返信待ちのユーザ投稿 (あれば最優先で次のステップを実行)
+        self.error_streak = 0     # LLMエラーの連続回数 (待ち時間を延ばす)
+        self.batch_failures = 0         # 一括生成の応答を読めなかった連続回数
+        self.batch_disabled_until = 0.0  # この時刻までは一括生成をやめて1人ずつ生成する
+
+    def has_viewers(self):
+        """SSE購読者がいるか、直近に画面・差分取得のアクセスがあれば閲覧中とみなす"""
+        timeout = config.get("scheduler", {}).get("VIEWER_TIMEOUT", 30)
+        return self.broadcaster.subscribers > 0 or time.time() - self.last_viewed < timeout
+
+rooms = {}
+rooms_lock = threading.Lock()
+
+def room_store_dir(room_id):
+    """ルームの会話ストアのディレクトリ (既定ルームは従来の場所)"""
+    base = config.get("conversation_store", {}).get("dir", "conversation_store")
+    if room_id == DEFAULT_ROOM_ID:
+        return base
+    return os.path.join(base, "rooms", room_id)
+
+def create_room(room_id):
+    """ルームを作成して会話を復元する。既にあればそれを返す"""
+    if state_backend:
+        # 同期処理と同じ順序 (バックエンド → ルーム一覧) でロックを取る
+        with state_backend.lock, rooms_lock:
+            room = rooms.get(room_id)
+            if room is None:
+                room = Room(room_id)
+                state_backend.attach_room(room)
+                rooms[room_id] = room
+            return room
+    with rooms_lock:
+        room = rooms.get(room_id)
+        if room is None:
+            room = Room(room_id)
+            load_conversation(room)
+            rooms[room_id] = room
+        return room
+
+def load_rooms():
+    """既定ルームと、ストア (共有バックエンドではDB) に会話が残っているルームを起動時に読み込む"""
+    create_room(DEFAULT_ROOM_ID)
+    room_ids = []
+    rooms_dir = os.path.join(room_store_dir(DEFAULT_ROOM_ID), "rooms")
+    if os.path.isdir(rooms_dir):
+        room_ids.extend(os.listdir(rooms_dir))
+    if state_backend:
+        room_ids.extend(state_backend.room_ids())
+    for room_id in sorted(set(room_ids)):
+        if ROOM_ID_PATTERN.match(room_id):
+            create_room(room_id)
+
+def touch_thread_config(room):
+    """thread_configの変更を記録 (プロンプトキャッシュの無効化とスケジューラへの通知)"""
+    room.thread_config_version += 1
+    room.name_matcher.set_agents(room.thread_config["agents"])
+    room_scheduler.wake(room)
+
+def update_thread_config(room, mutate):
+    """
+    thread_config / next_agent_id を mutate(room) で変更する。
+    共有バックエンドでは最新の設定を読み直したうえでトランザクション内で適用し、他プロセスへ伝える。
+    """
+    if state_backend:
+        state_backend.update_thread_config(room, mutate)
+    else:
+        mutate(room)
+    touch_thread_config(room)
 
-def export_thread_config_json():
+def export_thread_config_json(room):
     """thread_configをJSON文字列にして返す"""
-    return json.dumps(thread_config, ensure_ascii=False, indent=2)
+    return json.dumps(room.thread_config, ensure_ascii=False, indent=2)
 
-def import_thread_config_json(json_str):
+def import_thread_config_json(room, json_str):
     """JSON文字列を読み取り、thread_configを上書きする"""
-    global thread_config, next_agent_id
-    data = json.loads(json_str)
-    if "title" in data:
-        thread_config["title"] = data["title"]
-    if "agents" in data and isinstance(data["agents"], list):
-        thread_config["agents"] = data["agents"]
-        if thread_config["agents"]:
-            next_agent_id = max(a["id"] for a in thread_config["agents"]) + 1
-        else:
-            next_agent_id = 1
-    if "summary" in data:
-        thread_config["summary"] = data["summary"]
+    import_thread_config_data(room, json.loads(json_str))
+
+def import_thread_config_data(room, data, next_agent_id=None):
+    """
+    title / agents / summary のうち data にあるものでthread_configを上書きする。
+    next_agent_id (エクスポート元の値) を渡すと、削除済みのエージェントのIDも使い回さないようそれ以上にする。
+    """
+    def apply(room):
+        thread_config = room.thread_config
+        if "title" in data:
+            thread_config["title"] = data["title"]
+        if "agents" in data and isinstance(data["agents"], list):
+            thread_config["agents"] = data["agents"]
+            if thread_config["agents"]:
+                room.next_agent_id = max(a["id"] for a in thread_config["agents"]) + 1
+            else:
+                room.next_agent_id = 1
+        if next_agent_id:
+            room.next_agent_id = max(room.next_agent_id, int(next_agent_id))
+        if "summary" in data:
+            thread_config["summary"] = data["summary"]
+    update_thread_config(room, apply)
 
 ###############################################################################
 # 3. 会話ログ管理 (メモリ + 任意のファイル保存)
 ###############################################################################
 
-CONVERSATION_FILE = "conversation.json"
+CONVERSATION_FILE = "conversation.json"  # 旧形式 (初回起動時の移行元)
 
-conversation = []
-post_counter = 1
-
-def load_conversation():
-    """サーバー起動時に会話履歴を復元"""
-    global conversation, post_counter
-    if os.path.exists(CONVERSATION_FILE):
+class MessageStore:
+    """
+    追記専用のセグメント化ログ + 定期スナップショットによる会話ストア。
+    - 投稿ごとの書き込みはアクティブセグメントへの1行追記と、索引への固定長1レコードの追記のみ
+    - セグメントは件数・サイズ・経過時間のいずれかで切り替え、閉じたセグメントはgzipで圧縮して保存
+    - snapshot_interval 件ごとにメモリ上の会話(末尾)と読み出し位置をスナップショット保存
+    - 起動時はスナップショットを読み、その位置以降のセグメントを再生して復元
+    セグメントは全投稿の履歴としてそのまま残ります (retain_segments>0 で古いものを削除)。
+
+    各セグメントには索引 (segment-*.idx) が付きます。ヘッダにセグメント先頭の通し位置を持ち、
+    レコードは投稿ごとに (投稿番号, ブロック内オフセット, ブロック位置) の固定長です。
+    圧縮セグメントは compress_block_records 件ごとに独立したgzipメンバーとして書くため、
+    投稿番号から該当ブロックへ直接シークし、そのブロックだけを展開して読めます。
+    """
+    SEGMENT_PREFIX = "segment-"
+    SEGMENT_SUFFIX = ".jsonl"
+    ARCHIVE_SUFFIX = ".jsonl.gz"
+    INDEX_SUFFIX = ".idx"
+    SNAPSHOT_NAME = "snapshot.json"
+    INDEX_HEADER = struct.Struct("<4sIQ")  # マジック, 圧縮済みフラグ, 先頭レコードの通し位置
+    INDEX_RECORD = struct.Struct("<IIQ")   # 投稿番号, ブロック内オフセット, ブロック位置 (非圧縮ならファイル内オフセット)
+    INDEX_MAGIC = b"AIDX"
+
+    def __init__(self, directory, segment_max_records=10000, snapshot_interval=100, retain_segments=0,
+                 segment_max_bytes=0, segment_max_age=0, compress=False, compress_block_records=256,
+                 durability="flush", read_only=False):
+        self.directory = directory
+        self.segment_max_records = max(1, int(segment_max_records))
+        self.segment_max_bytes = int(segment_max_bytes or 0)
+        self.segment_max_age = float(segment_max_age or 0)
+        self.snapshot_interval = max(1, int(snapshot_interval))
+        self.retain_segments = int(retain_segments or 0)
+        self.compress = compress
+        self.compress_block_records = max(1, int(compress_block_records))
+        self.durability = durability  # flush / fsync_batch / fsync_message
+        self.lock = threading.RLock()
+        self._segment_id = None
+        self._segment_file = None
+        self._index_file = None
+        self._segment_records = 0
+        self._segment_started = 0.0
+        self._appends_since_snapshot = 0
+        if read_only:
+            # 他プロセスが書いているストアを読むだけの場合は、ファイルの修復や圧縮をしない
+            return
+        os.makedirs(directory, exist_ok=True)
+        self._repair_archives()
+
+    # --- セグメント操作 ---------------------------------------------------
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, f"{self.SEGMENT_PREFIX}{segment_id:06d}{self.SEGMENT_SUFFIX}")
+
+    def _archive_path(self, segment_id):
+        return os.path.join(self.directory, f"{self.SEGMENT_PREFIX}{segment_id:06d}{self.ARCHIVE_SUFFIX}")
+
+    def _index_path(self, segment_id):
+        return os.path.join(self.directory, f"{self.SEGMENT_PREFIX}{segment_id:06d}{self.INDEX_SUFFIX}")
+
+    def segment_ids(self):
+        ids = set()
+        if not os.path.isdir(self.directory):
+            return []
+        for name in os.listdir(self.directory):
+            if not name.startswith(self.SEGMENT_PREFIX):
+                continue
+            for suffix in (self.SEGMENT_SUFFIX, self.ARCHIVE_SUFFIX):
+                if name.endswith(suffix):
+                    try:
+                        ids.add(int(name[len(self.SEGMENT_PREFIX):-len(suffix)]))
+                    except ValueError:
+                        pass
+        return sorted(ids)
+
+    def _open_segment(self, segment_id):
+        """アクティブセグメントを開き、その索引を作り直して追記できる状態にする"""
+        if self._segment_file:
+            self._segment_file.close()
+            self._index_file.close()
+        path = self._segment_path(segment_id)
+        self._segment_file = open(path, "ab")
+        self._segment_id = segment_id
+        records = self._scan_segment(segment_id)
+        self._segment_records = len(records)
+        self._segment_started = time.time()
+        if records:
+            with open(path, "rb") as f:
+                f.seek(records[0][2])
+                try:
+                    self._segment_started = json.loads(f.readline()).get("timestamp", self._segment_started)
+                except ValueError:
+                    pass
+        self._write_index(segment_id, False, self._next_position(segment_id), records)
+        self._index_file = open(self._index_path(segment_id), "ab")
+
+    def _position(self):
+        """現在の書き込み位置 (segment_id, byte offset)"""
+        if self._segment_file is None:
+            ids = self.segment_ids()
+            self._open_segment(ids[-1] if ids else 1)
+        return self._segment_id, self._segment_file.tell()
+
+    def _should_rotate(self):
+        if self._segment_records >= self.segment_max_records:
+            return True
+        if self.segment_max_bytes and self._segment_file.tell() >= self.segment_max_bytes:
+            return True
+        if self.segment_max_age and self._segment_records and time.time() - self._segment_started >= self.segment_max_age:
+            return True
+        return False
+
+    def append(self, message):
+        """1件を現在のセグメントへ追記"""
+        self.append_many([message])
+
+    def append_many(self, messages):
+        """
+        まとめて追記し、書き出しは最後に1回だけ行う (グループコミット)。
+        件数・サイズ・経過時間の上限に達したら途中で次のセグメントへ切り替える。
+        durability が fsync_batch なら最後に1回、fsync_message なら1件ごとに fsync する。
+        """
+        with self.lock, metrics.timer("autochat_store_seconds", op="append"):
+            self._position()
+            for message in messages:
+                if self._should_rotate():
+                    self._flush(fsync=self.durability != "flush")
+                    closed_id = self._segment_id
+                    self._open_segment(closed_id + 1)
+                    if self.compress:
+                        threading.Thread(target=self.compress_segment, args=(closed_id,), daemon=True).start()
+                offset = self._segment_file.tell()
+                self._segment_file.write((json.dumps(message, ensure_ascii=False, default=Message.to_dict) + "\n").encode("utf-8"))
+                self._index_file.write(self.INDEX_RECORD.pack(message["number"], 0, offset))
+                self._segment_records += 1
+                self._appends_since_snapshot += 1
+                if self.durability == "fsync_message":
+                    self._flush(fsync=True)
+            self._flush(fsync=self.durability == "fsync_batch")
+
+    def _flush(self, fsync=False):
+        self._segment_file.flush()
+        self._index_file.flush()
+        if fsync:
+            os.fsync(self._segment_file.fileno())
+            os.fsync(self._index_file.fileno())
+
+    def should_snapshot(self):
+        return self._appends_since_snapshot >= self.snapshot_interval
+
+    # --- 索引 -------------------------------------------------------------
+
+    def _scan_segment(self, segment_id):
+        """非圧縮セグメントを読んで索引レコード (番号, 0, オフセット) の一覧を作る"""
+        records = []
+        with open(self._segment_path(segment_id), "rb") as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append((json.loads(line).get("number", 0), 0, offset))
+                except ValueError:
+                    break
+                offset += len(line)
+        return records
+
+    def _scan_archive(self, segment_id):
+        """圧縮セグメントを先頭から展開して索引レコード (番号, 展開後オフセット, 0) の一覧を作る"""
+        records = []
+        with self._open_reader(segment_id, True) as f:
+            offset = 0
+            for line in f:
+                records.append((json.loads(line).get("number", 0), offset, 0))
+                offset += len(line)
+        return records
+
+    def _write_index(self, segment_id, compressed, start, records):
+        path = self._index_path(segment_id)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, 1 if compressed else 0, start))
+            f.write(b"".join(self.INDEX_RECORD.pack(*r) for r in records))
+        os.replace(tmp_path, path)
+
+    def _read_index_header(self, segment_id):
+        """(圧縮済みか, 先頭の通し位置, レコード数)。索引が無ければ None"""
+        path = self._index_path(segment_id)
         try:
-            with open(CONVERSATION_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            conversation = data.get("messages", [])
-            post_counter = (conversation[-1]["number"] + 1) if conversation else 1
-        except Exception as e:
-            print(f"会話履歴の読み込みエラー: {e}")
-            conversation = []
-            post_counter = 1
-    else:
-        conversation = []
-        post_counter = 1
+            with open(path, "rb") as f:
+                magic, compressed, start = self.INDEX_HEADER.unpack(f.read(self.INDEX_HEADER.size))
+                size = os.fstat(f.fileno()).st_size
+        except (OSError, struct.error):
+            return None
+        if magic != self.INDEX_MAGIC:
+            return None
+        return bool(compressed), start, (size - self.INDEX_HEADER.size) // self.INDEX_RECORD.size
+
+    def _read_index_record(self, segment_id, i):
+        with open(self._index_path(segment_id), "rb") as f:
+            f.seek(self.INDEX_HEADER.size + i * self.INDEX_RECORD.size)
+            return self.INDEX_RECORD.unpack(f.read(self.INDEX_RECORD.size))
+
+    def _next_position(self, segment_id):
+        """segment_id の先頭に来る通し位置 (直前のセグメントの末尾の次)"""
+        previous = [i for i in self.segment_ids() if i < segment_id]
+        if not previous:
+            return 0
+        header = self._read_index_header(previous[-1])
+        return header[1] + header[2] if header else 0
+
+    def _repair_archives(self):
+        """
+        圧縮の途中で止まった跡を片付け、索引の無い古いセグメントに索引を作る。
+        索引が圧縮済みを指していれば非圧縮ファイルを、そうでなければ書きかけの圧縮ファイルを消す。
+        """
+        ids = self.segment_ids()
+        for segment_id in ids:
+            plain = self._segment_path(segment_id)
+            archive = self._archive_path(segment_id)
+            header = self._read_index_header(segment_id)
+            if os.path.exists(plain) and os.path.exists(archive):
+                os.remove(plain if header and header[0] else archive)
+            if header is None and os.path.exists(plain):
+                self._write_index(segment_id, False, self._next_position(segment_id), self._scan_segment(segment_id))
+            elif header is None:
+                # 索引を失った圧縮セグメントは全体を1ブロックとみなして作り直す
+                self._write_index(segment_id, True, self._next_position(segment_id), self._scan_archive(segment_id))
+        if self.compress:
+            for segment_id in ids[:-1]:
+                if os.path.exists(self._segment_path(segment_id)):
+                    threading.Thread(target=self.compress_segment, args=(segment_id,), daemon=True).start()
+
+    def compress_segment(self, segment_id):
+        """
+        閉じたセグメントを compress_block_records 件ごとのgzipメンバーに圧縮する。
+        圧縮ファイル → 索引の順に差し替え、最後に非圧縮ファイルを消す (途中で止まっても _repair_archives で復旧)。
+        """
+        plain = self._segment_path(segment_id)
+        archive = self._archive_path(segment_id)
+        header = self._read_index_header(segment_id)
+        if header is None or header[0] or segment_id == self._segment_id:
+            return
+        try:
+            with open(plain, "rb") as f:
+                lines = [line for line in f if line.endswith(b"\n")]
+            records = []
+            tmp_path = archive + ".tmp"
+            with open(tmp_path, "wb") as out:
+                for i in range(0, len(lines), self.compress_block_records):
+                    block_offset = out.tell()
+                    inner = 0
+                    block = lines[i:i + self.compress_block_records]
+                    for line in block:
+                        records.append((json.loads(line).get("number", 0), inner, block_offset))
+                        inner += len(line)
+                    out.write(gzip.compress(b"".join(block)))
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, archive)
+            with self.lock:
+                self._write_index(segment_id, True, header[1], records)
+                os.remove(plain)
+        except (OSError, ValueError) as e:
+            print(f"セグメント圧縮エラー ({plain}): {e}")
+
+    # --- 投稿番号による読み出し --------------------------------------------
+
+    def _open_reader(self, segment_id, compressed, block_offset=0, inner_offset=0):
+        """セグメントの指定位置から非圧縮の内容を順に読むファイルを返す"""
+        if not compressed:
+            f = open(self._segment_path(segment_id), "rb")
+            f.seek(block_offset)
+            return f
+        raw = open(self._archive_path(segment_id), "rb")
+        raw.seek(block_offset)
+        reader = gzip.GzipFile(fileobj=raw)
+        reader.myfileobj = raw  # close() で元のファイルも閉じる
+        reader.seek(inner_offset)
+        return reader
+
+    def _locate(self, number):
+        """
+        現在の番号付けの中で投稿番号 number の (segment_id, 索引番号) を返す。
+        同じ番号付けの投稿は連続して並ぶので、末尾からの差で索引の位置を直接求める。
+        """
+        segments = []
+        for segment_id in self.segment_ids():
+            header = self._read_index_header(segment_id)
+            if header and header[2]:
+                segments.append((segment_id, header[1], header[2]))
+        if not segments:
+            return None
+        last_id, last_start, last_count = segments[-1]
+        last_number = self._read_index_record(last_id, last_count - 1)[0]
+        position = last_start + last_count - 1 - (last_number - number)
+        if number > last_number or position < segments[0][1]:
+            return None
+        for segment_id, start, count in reversed(segments):
+            if start <= position < start + count:
+                if self._read_index_record(segment_id, position - start)[0] == number:
+                    return segment_id, position - start
+                break
+        return None
+
+    def read_range(self, first, last):
+        """
+        現在の番号付けで first〜last 番の投稿を読み出す (スナップショットより古く、メモリに無い投稿も読める)。
+        索引で開始位置へシークし、そこから順に読む。
+        """
+        with self.lock:
+            located = self._locate(first)
+            if located is None:
+                return []
+            segment_id, i = located
+            messages = []
+            previous = first - 1
+            for sid in [s for s in self.segment_ids() if s >= segment_id]:
+                header = self._read_index_header(sid)
+                if header is None:
+                    break
+                if sid == segment_id:
+                    _, inner, block = self._read_index_record(sid, i)
+                else:
+                    inner, block = 0, 0
+                with self._open_reader(sid, header[0], block, inner) as f:
+                    for line in f:
+                        msg = json.loads(line)
+                        if msg.get("number", 0) <= previous or msg["number"] > last:
+                            return messages
+                        messages.append(msg)
+                        previous = msg["number"]
+            return messages
+
+    def iter_lines(self):
+        """残っている全セグメントの投稿を、ログに書かれたままのJSON行 (bytes) で古い順に返す"""
+        for segment_id in self.segment_ids():
+            header = self._read_index_header(segment_id)
+            compressed = header[0] if header else not os.path.exists(self._segment_path(segment_id))
+            with self._open_reader(segment_id, compressed) as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    yield line
+
+    def iter_messages(self):
+        """残っている全セグメントの投稿を古い順に返す (検索インデックスの一括作成用)"""
+        for line in self.iter_lines():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+    # --- スナップショット / コンパクション --------------------------------
+
+    def write_snapshot(self, messages, next_number):
+        """メモリ上の会話と現在のログ位置をアトミックに保存し、不要なセグメントを整理"""
+        with self.lock, metrics.timer("autochat_store_seconds", op="snapshot"):
+            segment_id, offset = self._position()
+            data = {
+                "messages": list(messages),
+                "post_counter": next_number,
+                "segment": segment_id,
+                "offset": offset
+            }
+            path = os.path.join(self.directory, self.SNAPSHOT_NAME)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, default=Message.to_dict)
+                if self.durability != "flush":
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self._appends_since_snapshot = 0
+            self.compact(segment_id)
+
+    def compact(self, snapshot_segment_id):
+        """スナップショットより前の古いセグメントを retain_segments 個だけ残して削除"""
+        if self.retain_segments <= 0:
+            return
+        old_ids = [i for i in self.segment_ids() if i < snapshot_segment_id]
+        for segment_id in old_ids[:-self.retain_segments]:
+            for path in (self._segment_path(segment_id), self._archive_path(segment_id), self._index_path(segment_id)):
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                except OSError as e:
+                    print(f"セグメント削除エラー: {e}")
+
+    def read_snapshot(self):
+        path = os.path.join(self.directory, self.SNAPSHOT_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def is_empty(self):
+        return self.read_snapshot() is None and not self.segment_ids()
+
+    # --- 起動時の復元 -----------------------------------------------------
+
+    def recover(self, max_len):
+        """
+        スナップショット + 以降のセグメント再生で (messages, post_counter) を復元。
+        クラッシュで途中までしか書かれていない末尾行は切り詰めます。
+        """
+        with self.lock:
+            snapshot = self.read_snapshot() or {}
+            messages = deque(snapshot.get("messages", []), maxlen=max_len)
+            next_number = snapshot.get("post_counter", 1)
+            start_segment = snapshot.get("segment", 0)
+            start_offset = snapshot.get("offset", 0)
+
+            ids = [i for i in self.segment_ids() if i >= start_segment]
+            for segment_id in ids:
+                path = self._segment_path(segment_id)
+                if not os.path.exists(path):
+                    # 圧縮済みセグメントは書き込み完了後のものなので切り詰めは不要
+                    offset = start_offset if segment_id == start_segment else 0
+                    with self._open_reader(segment_id, True, 0, offset) as f:
+                        for line in f:
+                            msg = json.loads(line)
+                            if msg.get("number", 0) < next_number:
+                                continue
+                            messages.append(msg)
+                            next_number = msg["number"] + 1
+                    continue
+                with open(path, "rb+") as f:
+                    if segment_id == start_segment:
+                        f.seek(start_offset)
+                    while True:
+                        pos = f.tell()
+                        line = f.readline()
+                        if not line:
+                            break
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError("末尾行が途中で切れています")
+                            msg = json.loads(line)
+                        except ValueError as e:
+                            print(f"会話ログの破損を検出 ({path} @ {pos}): {e}")
+                            f.truncate(pos)
+                            break
+                        # スナップショット取得と追記が前後した場合の重複を除外
+                        if msg.get("number", 0) < next_number:
+                            continue
+                        messages.append(msg)
+                        next_number = msg["number"] + 1
+            self._open_segment(ids[-1] if ids else max(start_segment, 1))
+            return list(messages), next_number
+
+    def import_legacy(self, log_file, conversation_file):
+        """旧形式 (conversation_log.jsonl + conversation.json) からストアを初期化"""
+        if os.path.exists(log_file):
+            with open(log_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.append(json.loads(line))
+        messages, next_number = [], 1
+        if os.path.exists(conversation_file):
+            with open(conversation_file, "r", encoding="utf-8") as f:
+                messages = json.load(f).get("messages", [])
+            next_number = (messages[-1]["number"] + 1) if messages else 1
+        self.write_snapshot(messages, next_number)
+
+class HistoryIndex:
+    """
+    全投稿の検索用インデックス (SQLite FTS5)。
+    会話ストアへの追記と同時に1行ずつ登録し、本文検索・発言者・返信先・期間での絞り込みと
+    新しい順のページングをインデックスだけで行います (JSONLログは走査しません)。
+    本文は trigram トークナイザで索引するため、日本語でも部分一致で検索できます (3文字未満の語はLIKEで照合)。
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY,
+                room_id TEXT NOT NULL,
+                number INTEGER NOT NULL,
+                agent TEXT NOT NULL,
+                reply_to TEXT,
+                text TEXT NOT NULL,
+                timestamp REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_room ON history (room_id, id);
+            CREATE INDEX IF NOT EXISTS history_agent ON history (room_id, agent, id);
+            CREATE INDEX IF NOT EXISTS history_time ON history (room_id, timestamp);
+            CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                text, content='history', content_rowid='id', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS history_ai AFTER INSERT ON history BEGIN
+                INSERT INTO history_fts (rowid, text) VALUES (new.id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS history_ad AFTER DELETE ON history BEGIN
+                INSERT INTO history_fts (history_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END;
+        """)
+
+    def _rows(self, room_id, messages):
+        for msg in messages:
+            yield (room_id, msg["number"], msg["agent"], msg.get("reply_to"), msg["text"],
+                   msg.get("timestamp", 0))
+
+    def add(self, room_id, message):
+        self.add_many(room_id, [message])
+
+    def add_many(self, room_id, messages):
+        """まとめて1トランザクションで登録する"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO history (room_id, number, agent, reply_to, text, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                self._rows(room_id, messages)
+            )
+
+    def is_empty(self, room_id):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM history WHERE room_id = ? LIMIT 1", (room_id,)).fetchone() is None
+
+    def rebuild(self, room_id, messages):
+        """ルームの索引を消して messages (全履歴) から作り直す"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM history WHERE room_id = ?", (room_id,))
+            self.conn.executemany(
+                "INSERT INTO history (room_id, number, agent, reply_to, text, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                self._rows(room_id, messages)
+            )
 
-def save_conversation():
-    """conversation.json に会話を保存"""
-    data = {"messages": conversation}
+    def search(self, room_id, query="", agent="", reply_to="", since=None, until=None, before=None, limit=50):
+        """
+        条件に合う投稿を新しい順に最大 limit 件返す。
+        戻り値は (投稿のリスト, 次のページ用の before)。次のページが無ければ before は None。
+        """
+        where = ["h.room_id = ?"]
+        params = [room_id]
+        fts_terms = []
+        for term in query.split():
+            if len(term) >= 3:
+                fts_terms.append('"' + term.replace('"', '""') + '"')
+            else:
+                where.append("h.text LIKE ? ESCAPE '\\'")
+                params.append("%" + re.sub(r"([%_\\])", r"\\\1", term) + "%")
+        if fts_terms:
+            where.append("h.id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+            params.append(" AND ".join(fts_terms))
+        if agent:
+            where.append("h.agent = ?")
+            params.append(agent)
+        if reply_to:
+            where.append("h.reply_to = ?")
+            params.append(reply_to)
+        if since is not None:
+            where.append("h.timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("h.timestamp < ?")
+            params.append(until)
+        if before is not None:
+            where.append("h.id < ?")
+            params.append(before)
+        sql = ("SELECT h.id, h.number, h.agent, h.reply_to, h.text, h.timestamp FROM history h WHERE "
+               + " AND ".join(where) + " ORDER BY h.id DESC LIMIT ?")
+        params.append(limit + 1)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        results = [
+            {"id": row[0], "number": row[1], "agent": row[2], "reply_to": row[3], "text": row[4], "timestamp": row[5]}
+            for row in rows[:limit]
+        ]
+        next_before = results[-1]["id"] if len(rows) > limit else None
+        return results, next_before
+
+history_index = None  # 検索インデックス (config["search_index"]["enabled"] が false なら None)
+
+def open_history_index():
+    global history_index
+    index_config = config.get("search_index", {})
+    if not index_config.get("enabled", True):
+        return
     try:
-        with open(CONVERSATION_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        history_index = HistoryIndex(index_config.get("path", "history.db"))
+    except sqlite3.Error as e:
+        print(f"検索インデックスを開けません: {e}")
+
+def index_message(room_id, message):
+    """投稿1件を検索インデックスへ登録"""
+    index_messages(room_id, [message])
+
+def index_messages(room_id, messages):
+    """投稿をまとめて検索インデックスへ登録 (失敗しても投稿自体は止めない)"""
+    if history_index is None:
+        return
+    try:
+        history_index.add_many(room_id, messages)
+    except sqlite3.Error as e:
+        print(f"検索インデックスの更新エラー: {e}")
+
+def build_history_index(room_id, message_store, rebuild=False):
+    """
+    会話ストアの全セグメントから検索インデックスを一括作成する。
+    rebuild=False ならインデックスが空のルームだけを対象にする (初回起動・既存ログの取り込み用)。
+    """
+    if history_index is None:
+        return
+    try:
+        if rebuild:
+            history_index.rebuild(room_id, message_store.iter_messages())
+        elif history_index.is_empty(room_id):
+            history_index.add_many(room_id, message_store.iter_messages())
+    except (sqlite3.Error, OSError) as e:
+        print(f"検索インデックスの作成エラー: {e}")
+
+def rebuild_history_index(room):
+    """
+    ルームの検索インデックスを会話ストアから作り直す (索引が欠けた・古くなった場合の管理用)。
+    投稿の書き込みと前後しないよう、非同期保存なら書き込みスレッドの列に並べて終わるまで待つ。
+    """
+    if room.message_store is not None and persistence_is_async():
+        persistence_writer.submit(room, "reindex", None)
+        persistence_writer.flush()
+        return
+    lock = state_backend.lock if state_backend else room.lock
+    with lock:
+        build_history_index(room.room_id, log_reader(room), rebuild=True)
+
+def new_message_store(room_id, read_only=False):
+    """設定に従ってルームの会話ストアを作る"""
+    store_config = config.get("conversation_store", {})
+    return MessageStore(
+        room_store_dir(room_id),
+        segment_max_records=store_config.get("SEGMENT_MAX_RECORDS", 10000),
+        snapshot_interval=store_config.get("SNAPSHOT_INTERVAL", 100),
+        retain_segments=store_config.get("RETAIN_SEGMENTS", 0),
+        segment_max_bytes=store_config.get("SEGMENT_MAX_BYTES", 16 * 1024 * 1024),
+        segment_max_age=store_config.get("SEGMENT_MAX_AGE", 0),
+        compress=store_config.get("COMPRESS_SEGMENTS", True),
+        compress_block_records=store_config.get("COMPRESS_BLOCK_RECORDS", 256),
+        durability=config.get("persistence", {}).get("DURABILITY", "flush"),
+        read_only=read_only
+    )
+
+def open_message_store(room):
+    """ルームの会話ストアを開く"""
+    room.message_store = new_message_store(room.room_id)
+    return room.message_store
+
+def log_reader(room):
+    """
+    投稿番号での読み出しに使うストア。共有バックエンドでリーダー以外のプロセスは
+    リーダーが書いているストアを読み取り専用で開く。
+    """
+    if room.message_store is not None:
+        return room.message_store
+    if state_backend and room.room_id in state_backend.stores:
+        return state_backend.stores[room.room_id]
+    return new_message_store(room.room_id, read_only=True)
+
+def load_conversation(room):
+    """サーバー起動時にスナップショット + ログ再生で会話履歴を復元"""
+    message_store = open_message_store(room)
+    max_len = config["conversation"].get("MAX_CONVERSATION_LENGTH", 100)
+    try:
+        if room.room_id == DEFAULT_ROOM_ID and message_store.is_empty():
+            message_store.import_legacy(
+                config.get("conversation_log_file", "conversation_log.jsonl"), CONVERSATION_FILE
+            )
+        messages, room.post_counter = message_store.recover(max_len)
+        room.conversation.replace(messages, max_len)
+    except Exception as e:
+        print(f"会話履歴の読み込みエラー: {e}")
+        room.conversation.clear()
+        room.post_counter = 1
+    persistence_writer.register(room, max_len)
+    build_history_index(room.room_id, message_store)
+    room.name_matcher.rebuild(room.conversation, room.thread_config["agents"])
+
+def persistence_is_async():
+    return config.get("persistence", {}).get("MODE", "async") == "async"
+
+def save_conversation(room):
+    """現在の会話をスナップショットとして保存 (クリア時・定期的に呼ばれる)"""
+    if room.message_store is None:
+        return
+    if persistence_is_async():
+        # 先に受け付けた投稿の書き込みより後に保存されるよう、書き込みスレッドの列に並べる
+        persistence_writer.submit(room, "snapshot", (list(room.conversation), room.post_counter))
+        return
+    try:
+        room.message_store.write_snapshot(room.conversation, room.post_counter)
     except Exception as e:
         print(f"会話履歴の保存エラー: {e}")
 
-def log_message_to_file(message):
-    """1行ずつJSONで追記保存するログファイル"""
-    log_file = config.get("conversation_log_file", "conversation_log.jsonl")
+def log_message_to_file(room, message):
+    """
+    投稿をセグメントへ追記保存し、一定件数ごとにスナップショットを取る。
+    persistence.MODE が async (既定) なら書き込みスレッドに渡してすぐ戻る。
+    """
+    if room.message_store is None:
+        # 共有バックエンドでログを書くのはリーダープロセスだけ
+        return
+    if persistence_is_async():
+        persistence_writer.submit(room, "post", message)
+        return
     try:
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(message, ensure_ascii=False) + "\n")
+        room.message_store.append(message)
     except Exception as e:
         print(f"会話ログの保存エラー: {e}")
+        return
+    index_message(room.room_id, message)
+    if room.message_store.should_snapshot():
+        save_conversation(room)
+
+class PersistenceWriter:
+    """
+    会話ストアへの書き込みを専用スレッドでまとめて行う (グループコミット)。
+    - 投稿はメモリに入った時点で呼び出し元へ戻り、スレッドが FLUSH_INTERVAL 秒または BATCH_SIZE 件ごとにまとめて書く
+    - 同じルームの連続した投稿は、1回の追記と1回の検索インデックス更新にまとめる
+    - スナップショット (クリア時など) も投稿と同じ列で処理し、前後関係を保つ
+    - 定期スナップショットは書き込み済みの投稿から作る (メモリ上の会話は書き込みより先に進んでいるため)
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = []
+        self.busy = False
+        self.thread = None
+        self.tails = {}  # room_id -> [書き込み済みの直近の投稿 (deque), 次の投稿番号]
+
+    def register(self, room, max_len):
+        """起動時に復元したルームの会話を、書き込み済みの状態として登録する"""
+        with self.cond:
+            self.tails[room.room_id] = [deque(room.conversation, maxlen=max_len), room.post_counter]
+
+    def submit(self, room, kind, payload):
+        with self.cond:
+            self.queue.append((room, kind, payload))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """列に並んでいる書き込みがすべて終わるまで待つ。タイムアウトしたら False"""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.queue and not self.busy, timeout)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.queue)
+                persistence_config = config.get("persistence", {})
+                batch_size = max(1, int(persistence_config.get("BATCH_SIZE", 256)))
+                # 少しだけ待って、続けて届く投稿を同じ書き込みにまとめる
+                deadline = time.time() + persistence_config.get("FLUSH_INTERVAL", 0.05)
+                while len(self.queue) < batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch, self.queue = self.queue[:batch_size], self.queue[batch_size:]
+                self.busy = True
+            try:
+                self._write(batch)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def _write(self, batch):
+        i = 0
+        while i < len(batch):
+            room, kind, payload = batch[i]
+            store = room.message_store
+            tail = self.tails.get(room.room_id)
+            if tail is None:
+                max_len = config["conversation"].get("MAX_CONVERSATION_LENGTH", 100)
+                tail = self.tails[room.room_id] = [deque(maxlen=max_len), 1]
+            if kind == "snapshot":
+                messages, next_number = payload
+                try:
+                    store.write_snapshot(messages, next_number)
+                except Exception as e:
+                    print(f"会話履歴の保存エラー: {e}")
+                tail[0].clear()
+                tail[0].extend(messages)
+                tail[1] = next_number
+                i += 1
+                continue
+            if kind == "reindex":
+                # 書き込み済みの投稿だけで作り直す (この後の投稿は、書いたときに索引へ加わる)
+                build_history_index(room.room_id, store, rebuild=True)
+                i += 1
+                continue
+            group = [payload]
+            i += 1
+            while i < len(batch) and batch[i][0] is room and batch[i][1] == "post":
+                group.append(batch[i][2])
+                i += 1
+            try:
+                store.append_many(group)
+            except Exception as e:
+                print(f"会話ログの保存エラー: {e}")
+                continue
+            tail[0].extend(group)
+            tail[1] = group[-1]["number"] + 1
+            index_messages(room.room_id, group)
+            if store.should_snapshot():
+                try:
+                    store.write_snapshot(list(tail[0]), tail[1])
+                except Exception as e:
+                    print(f"会話履歴の保存エラー: {e}")
+
+persistence_writer = PersistenceWriter()
+
+def estimate_tokens(text):
+    """
+    トークン数の概算 (トークナイザに依存しない)。
+    日本語など非ASCII文字は1文字1トークン、ASCIIは4文字で1トークンとして数える。
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+def message_tokens(msg):
+    """投稿のトークン数。投稿時に計算して投稿に保存し、古いログの投稿は初回に計算して保存する"""
+    tokens = msg.get("tokens")
+    if tokens is None:
+        tokens = msg["tokens"] = estimate_tokens(msg["text"])
+    return tokens
+
+def truncate_to_tokens(text, budget, marker="…(略)"):
+    """text を概算 budget トークンに収まるよう末尾を切り詰める"""
+    if estimate_tokens(text) <= budget:
+        return text
+    budget -= estimate_tokens(marker)
+    used = 0
+    for i, ch in enumerate(text):
+        used += 1 if ord(ch) >= 128 else 0.25
+        if used > budget:
+            return text[:i] + marker
+    return text
+
+def messages_since(room, number):
+    """投稿番号 number より新しい投稿を古い順に返す (末尾から走査するので差分量に比例)"""
+    return room.conversation.since(number)
+
+class Broadcaster:
+    """
+    新着イベントを全購読者へ配信するファンアウト。
+    イベントは publish 時に1回だけSSE形式へ整形し、全購読者が同じ文字列を共有します。
+    直近 history 件をリングとして保持し、購読者はイベントIDのカーソルで追いかけます。
+    """
+    def __init__(self, history=256, keepalive=15):
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=history)  # (event_id, payload)
+        self.last_id = 0
+        self.keepalive = keepalive
+        self.subscribers = 0  # 接続中の購読者数 (閲覧中ルームの判定に使う)
+
+    def publish(self, event, data):
+        with self.cond:
+            self.last_id += 1
+            payload = f"id: {self.last_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            self.events.append((self.last_id, payload))
+            self.cond.notify_all()
+
+    def subscribe(self, last_id=None):
+        """SSEのテキストを返し続けるジェネレータ。取りこぼしがあれば reset を送る"""
+        cursor = self.last_id if last_id is None else last_id
+        with self.cond:
+            self.subscribers += 1
+        try:
+            if cursor > self.last_id:
+                # サーバー再起動などでIDが巻き戻った場合は全体の再取得を促す
+                cursor = self.last_id
+                yield f"id: {cursor}\nevent: reset\ndata: {{}}\n\n"
+            while True:
+                with self.cond:
+                    if cursor >= self.last_id:
+                        self.cond.wait(self.keepalive)
+                    pending = [p for i, p in self.events if i > cursor]
+                    oldest = self.events[0][0] if self.events else self.last_id + 1
+                    missed = cursor + 1 < oldest and cursor < self.last_id
+                    cursor = self.last_id
+                if missed:
+                    yield f"id: {cursor}\nevent: reset\ndata: {{}}\n\n"
+                elif pending:
+                    yield "".join(pending)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            with self.cond:
+                self.subscribers -= 1
+
+def publish_new_message(room, msg, draft_id=None):
+    """投稿1件をHTML断片にして配信 (購読者数に関わらず描画・整形は1回)"""
+    with metrics.timer("autochat_render_seconds", view="post_event"):
+        html = render_posts([msg])
+    data = {"number": msg["number"], "epoch": room.conversation_epoch, "html": html}
+    if draft_id:
+        # ストリーミング表示中の下書きをこの投稿で置き換える
+        data["draft"] = draft_id
+    room.broadcaster.publish("post", data)
+
+def append_message(room, agent_name, text, reply_to=None, draft_id=None):
+    """新しい投稿を番号付きで会話に追加し、ログへ追記。長さ制限もここで適用"""
+    if state_backend:
+        # 採番は共有DBのトランザクションで行い、取り込みは全プロセス共通の同期処理に任せる
+        return state_backend.insert_post(room, agent_name, text, reply_to, draft_id)
+    # 番号の採番から追記までをまとめて行い、同時投稿でも番号が重複しないようにする
+    with room.lock:
+        new_msg = {
+            "number": room.post_counter,
+            "agent": agent_name,
+            "reply_to": reply_to,
+            "text": text,
+            "timestamp": time.time(),
+            "tokens": estimate_tokens(text)
+        }
+        apply_new_message(room, new_msg, draft_id)
+    # 自動要約判定
+    on_new_message_posted(room)
+    return new_msg
+
+def apply_new_message(room, new_msg, draft_id=None):
+    """番号の決まった投稿をメモリ上の会話に取り込み、ログ追記・配信・長さ制限を行う"""
+    max_len = config["conversation"].get("MAX_CONVERSATION_LENGTH", 100)
+    conversation = room.conversation
+    new_msg = Message.from_dict(new_msg)
+    with room.lock:
+        # 長さ制限 (設定で変わったときだけ作り直す。通常は追加時の押し出しのみ)
+        for evicted in conversation.resize(max_len):
+            room.name_matcher.remove(evicted.agent)
+        evicted = conversation.append(new_msg)
+        if evicted is not None:
+            room.name_matcher.remove(evicted.agent)
+        room.post_counter = new_msg.number + 1
+        room.name_matcher.add(new_msg["agent"])
+        log_message_to_file(room, new_msg)
+        publish_new_message(room, new_msg, draft_id)
+        if not any(a["name"] == new_msg["agent"] for a in room.thread_config["agents"]):
+            # エージェント以外 (ユーザ) の投稿はスケジューラに知らせてすぐ返信させる
+            room_scheduler.notify_user_post(room, new_msg)
+
+def clear_messages(room):
+    """会話をクリアし、世代を進めて閲覧者に再取得を促す"""
+    if state_backend:
+        state_backend.insert_clear(room)
+        return
+    apply_clear(room, room.conversation_epoch + 1)
+
+def apply_clear(room, epoch):
+    with room.lock:
+        room.conversation.clear()
+        room.post_counter = 1
+        room.conversation_epoch = epoch
+        room.name_matcher.rebuild(room.conversation, room.thread_config["agents"])
+        save_conversation(room)
+    room.broadcaster.publish("reset", {"epoch": room.conversation_epoch})
+
+EXPORT_CHUNK_BYTES = 64 * 1024
+IMPORT_BATCH_SIZE = 1000
+
+def export_conversation_ndjson(room):
+    """
+    スレッド設定と全履歴をNDJSONで少しずつ返すジェネレータ。
+    1行目はスレッド設定 ({"type": "thread_config", ...})、2行目以降は会話ストアの投稿の行をそのまま流す
+    (履歴全体をメモリに読み込まない)。クリア前の投稿も含む。
+    """
+    if room.message_store is not None:
+        # 書き込みスレッドに残っている投稿もログに出してから読む
+        persistence_writer.flush()
+    header = {"type": "thread_config", "thread_config": room.thread_config, "next_agent_id": room.next_agent_id}
+    chunk = [(json.dumps(header, ensure_ascii=False) + "\n").encode("utf-8")]
+    size = len(chunk[0])
+    for line in log_reader(room).iter_lines():
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+def import_conversation_ndjson(room, lines):
+    """
+    export_conversation_ndjson の形式の行を読み、現在の会話の後ろへ投稿を一括で取り込む。
+    - 投稿は post_counter から振り直す (返信先はエージェント名なのでそのまま)
+    - スレッド設定の行があれば設定と next_agent_id も取り込む
+    - IMPORT_BATCH_SIZE 件ごとに会話ストアへまとめて追記し、検索インデックスもまとめて登録する
+    - 1件ごとのスナップショット・配信・自動要約判定は行わず、最後にスナップショットを1回取る
+    取り込んだ投稿数を返す。
+    """
+    if state_backend:
+        raise ValueError("共有バックエンドでは会話のインポートに対応していません")
+    max_len = config["conversation"].get("MAX_CONVERSATION_LENGTH", 100)
+    store = room.message_store
+    tail = deque(room.conversation, maxlen=max_len)
+    batch = []
+    count = 0
+
+    def write_batch():
+        nonlocal batch, count
+        if batch:
+            store.append_many(batch)
+            index_messages(room.room_id, batch)
+            tail.extend(batch)
+            count += len(batch)
+            batch = []
+
+    with room.lock:
+        persistence_writer.flush()
+        try:
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                data = json.loads(line)
+                if data.get("type") == "thread_config":
+                    import_thread_config_data(room, data.get("thread_config", {}), data.get("next_agent_id"))
+                    continue
+                msg = Message.from_dict(data)
+                msg.number = room.post_counter
+                room.post_counter += 1
+                batch.append(msg)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    write_batch()
+        finally:
+            # 途中で失敗しても、読めた分までで会話とスナップショットを揃える
+            write_batch()
+            room.conversation.replace(tail, max_len)
+            room.name_matcher.rebuild(room.conversation, room.thread_config["agents"])
+            store.write_snapshot(room.conversation, room.post_counter)
+            persistence_writer.register(room, max_len)
+            room.broadcaster.publish("reset", {"epoch": room.conversation_epoch})
+    return count
+
+class SqliteStateBackend:
+    """
+    複数のワーカープロセスで会話状態を共有するためのSQLite (WALモード) バックエンド。
+    - 投稿の採番・クリア・スレッド設定の更新はDBのトランザクションで行い、全プロセスで一貫させる
+    - 各プロセスは PRAGMA data_version で他プロセスの書き込みを検知し、posts の通し番号 (seq) の
+      カーソルから新着だけをメモリ上のルームへ取り込む (閲覧・差分取得・SSEは従来どおりメモリから返す)
+    - エージェント投稿・自動要約・会話ストアへのログ書き込みは、リースを持つリーダープロセスだけが行う
+    """
+    def __init__(self, path, lease_seconds=15, poll_interval=0.5):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS rooms (
+                room_id TEXT PRIMARY KEY,
+                thread_config TEXT NOT NULL,
+                next_agent_id INTEGER NOT NULL,
+                post_counter INTEGER NOT NULL,
+                epoch INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                logged_seq INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS posts (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                room_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                epoch INTEGER NOT NULL,
+                number INTEGER NOT NULL,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS posts_room ON posts (room_id, seq);
+            CREATE TABLE IF NOT EXISTS leader (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                owner TEXT,
+                expires REAL NOT NULL
+            );
+            INSERT OR IGNORE INTO leader (id, owner, expires) VALUES (1, NULL, 0);
+        """)
+        self.last_seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM posts").fetchone()[0]
+        self.rooms_version = 0
+        self.data_version = None
+        self.is_leader = False
+        self.stores = {}  # room_id -> MessageStore (リーダーのみ)
+        self.thread = None
+
+    def start(self):
+        """リースの取得を試み、他プロセスの変更を取り込むポーリングスレッドを開始する"""
+        self.renew_lease()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._poll, daemon=True)
+            self.thread.start()
+
+    def _poll(self):
+        next_renew = time.time() + self.lease_seconds / 3
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.sync_if_changed()
+                if time.time() >= next_renew:
+                    self.renew_lease()
+                    next_renew = time.time() + self.lease_seconds / 3
+            except Exception as e:
+                print(f"共有状態の同期エラー: {e}")
+
+    def _transaction(self):
+        """書き込みトランザクション (BEGIN IMMEDIATE で最初に書き込みロックを取る)"""
+        backend = self
+
+        class Transaction:
+            def __enter__(self):
+                backend.conn.execute("BEGIN IMMEDIATE")
+                return backend.conn
+
+            def __exit__(self, exc_type, exc, tb):
+                backend.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return Transaction()
+
+    def room_ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT room_id FROM rooms")]
+
+    def attach_room(self, room):
+        """ルームをDBと結び付け、設定と直近の会話を読み込む。DBに無ければ会話ストアの内容で登録する"""
+        max_len = config["conversation"].get("MAX_CONVERSATION_LENGTH", 100)
+        with self.lock:
+            with self._transaction() as conn:
+                row = conn.execute(
+                    "SELECT thread_config, next_agent_id, post_counter, epoch, version FROM rooms WHERE room_id = ?",
+                    (room.room_id,)
+                ).fetchone()
+                if row is None:
+                    # 初回は従来の会話ストアから取り込む (単一プロセス運用からの移行)
+                    load_conversation(room)
+                    room.message_store = None
+                    version = self._next_version(conn)
+                    conn.execute(
+                        "INSERT INTO rooms (room_id, thread_config, next_agent_id, post_counter, epoch, version)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (room.room_id, json.dumps(room.thread_config, ensure_ascii=False), room.next_agent_id,
+                         room.post_counter, room.conversation_epoch, version)
+                    )
+                    for msg in room.conversation:
+                        self._insert_post_row(conn, room.room_id, room.conversation_epoch, msg)
+                    conn.execute(
+                        "UPDATE rooms SET logged_seq = (SELECT COALESCE(MAX(seq), 0) FROM posts) WHERE room_id = ?",
+                        (room.room_id,)
+                    )
+                    room.version = version
+                    return
+                thread_config, room.next_agent_id, room.post_counter, room.conversation_epoch, room.version = row
+                room.thread_config = json.loads(thread_config)
+                rows = conn.execute(
+                    "SELECT data FROM posts WHERE room_id = ? AND kind = 'post' AND epoch = ?"
+                    " ORDER BY seq DESC LIMIT ?",
+                    (room.room_id, room.conversation_epoch, max_len)
+                ).fetchall()
+            room.conversation.replace([json.loads(data) for (data,) in reversed(rows)], max_len)
+            room.name_matcher.rebuild(room.conversation, room.thread_config["agents"])
+            room.thread_config_version += 1
+
+    def _next_version(self, conn):
+        return conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM rooms").fetchone()[0]
+
+    def _insert_post_row(self, conn, room_id, epoch, msg):
+        conn.execute(
+            "INSERT INTO posts (room_id, kind, epoch, number, data) VALUES (?, 'post', ?, ?, ?)",
+            (room_id, epoch, msg["number"], json.dumps(msg, ensure_ascii=False, default=Message.to_dict))
+        )
+
+    def insert_post(self, room, agent_name, text, reply_to=None, draft_id=None):
+        """投稿を採番してDBに追加し、すぐに自プロセスへ取り込む"""
+        with self.lock:
+            with self._transaction() as conn:
+                number, epoch = conn.execute(
+                    "SELECT post_counter, epoch FROM rooms WHERE room_id = ?", (room.room_id,)
+                ).fetchone()
+                new_msg = {
+                    "number": number,
+                    "agent": agent_name,
+                    "reply_to": reply_to,
+                    "text": text,
+                    "timestamp": time.time(),
+                    "tokens": estimate_tokens(text)
+                }
+                self._insert_post_row(conn, room.room_id, epoch, new_msg)
+                conn.execute("UPDATE rooms SET post_counter = ? WHERE room_id = ?", (number + 1, room.room_id))
+            if draft_id:
+                room.pending_drafts[(epoch, number)] = draft_id
+            self.sync()
+        return new_msg
+
+    def insert_clear(self, room):
+        """会話のクリアを記録して世代を進め、すぐに自プロセスへ取り込む"""
+        with self.lock:
+            with self._transaction() as conn:
+                epoch = conn.execute("SELECT epoch FROM rooms WHERE room_id = ?", (room.room_id,)).fetchone()[0] + 1
+                conn.execute(
+                    "INSERT INTO posts (room_id, kind, epoch, number) VALUES (?, 'clear', ?, 0)", (room.room_id, epoch)
+                )
+                conn.execute("UPDATE rooms SET epoch = ?, post_counter = 1 WHERE room_id = ?", (epoch, room.room_id))
+            self.sync()
+
+    def update_thread_config(self, room, mutate):
+        """DB上の最新の設定に mutate(room) を適用して書き戻す (他プロセスの変更を上書きしない)"""
+        with self.lock:
+            with self._transaction() as conn:
+                thread_config, room.next_agent_id = conn.execute(
+                    "SELECT thread_config, next_agent_id FROM rooms WHERE room_id = ?", (room.room_id,)
+                ).fetchone()
+                room.thread_config = json.loads(thread_config)
+                mutate(room)
+                room.version = self._next_version(conn)
+                conn.execute(
+                    "UPDATE rooms SET thread_config = ?, next_agent_id = ?, version = ? WHERE room_id = ?",
+                    (json.dumps(room.thread_config, ensure_ascii=False), room.next_agent_id,
+                     room.version, room.room_id)
+                )
+
+    def sync_if_changed(self):
+        """他プロセスがDBを更新していれば取り込む (変更が無ければPRAGMA 1回で済む)"""
+        with self.lock:
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version:
+                return
+            self.data_version = data_version
+            self.sync()
+
+    def sync(self):
+        """設定が変わったルームと、カーソル以降の投稿・クリアをメモリ上のルームへ取り込む"""
+        with self.lock:
+            changed = self.conn.execute(
+                "SELECT room_id, thread_config, next_agent_id, version FROM rooms WHERE version > ? ORDER BY version",
+                (self.rooms_version,)
+            ).fetchall()
+            for room_id, thread_config, next_agent_id, version in changed:
+                self.rooms_version = max(self.rooms_version, version)
+                room = rooms.get(room_id)
+                if room is None:
+                    create_room(room_id)
+                elif version > room.version:
+                    room.thread_config = json.loads(thread_config)
+                    room.next_agent_id = next_agent_id
+                    room.version = version
+                    touch_thread_config(room)
+
+            rows = self.conn.execute(
+                "SELECT seq, room_id, kind, epoch, number, data FROM posts WHERE seq > ? ORDER BY seq",
+                (self.last_seq,)
+            ).fetchall()
+            for seq, room_id, kind, epoch, number, data in rows:
+                self.last_seq = seq
+                room = rooms.get(room_id) or create_room(room_id)
+                if kind == "clear":
+                    if epoch > room.conversation_epoch:
+                        apply_clear(room, epoch)
+                    continue
+                # 読み込み時に取り込み済みの投稿は飛ばす
+                if epoch != room.conversation_epoch or number < room.post_counter:
+                    continue
+                apply_new_message(room, json.loads(data), room.pending_drafts.pop((epoch, number), None))
+                if self.is_leader:
+                    on_new_message_posted(room)
+            if self.is_leader and rows:
+                self.flush_logs()
+
+    def renew_lease(self):
+        """リーダーのリースを取得・更新する。状態が変わればスケジューラとログ書き込みを切り替える"""
+        with self.lock:
+            now = time.time()
+            with self._transaction() as conn:
+                acquired = conn.execute(
+                    "UPDATE leader SET owner = ?, expires = ? WHERE id = 1 AND (owner = ? OR expires < ?)",
+                    (self.owner, now + self.lease_seconds, self.owner, now)
+                ).rowcount == 1
+            if acquired == self.is_leader:
+                return
+            self.is_leader = acquired
+            if acquired:
+                print(f"共有状態: このプロセス ({self.owner}) がリーダーになりました。")
+                self.sync()
+                self.flush_logs()
+            else:
+                print(f"共有状態: このプロセス ({self.owner}) はリーダーではなくなりました。")
+                self.stores.clear()
+        for room in list(rooms.values()):
+            room_scheduler.wake(room)
+
+    def flush_logs(self):
+        """
+        リーダーだけが行う会話ストアへの書き込み。ルームごとの logged_seq 以降を追記し、
+        ログに書き終えた古い投稿はDBから削除して posts テーブルを会話の長さ程度に保つ。
+        """
+        max_len = config["conversation"].get("MAX_CONVERSATION_LENGTH", 100)
+        with self.lock:
+            pending = self.conn.execute(
+                "SELECT room_id, logged_seq FROM rooms WHERE logged_seq < ?", (self.last_seq,)
+            ).fetchall()
+            for room_id, logged_seq in pending:
+                room = rooms.get(room_id)
+                if room is None:
+                    continue
+                store = self.stores.get(room_id)
+                if store is None:
+                    store = self.stores[room_id] = new_message_store(room_id)
+                rows = self.conn.execute(
+                    "SELECT kind, data FROM posts WHERE room_id = ? AND seq > ? AND seq <= ? ORDER BY seq",
+                    (room_id, logged_seq, self.last_seq)
+                ).fetchall()
+                try:
+                    # クリアの記録で区切りながら、連続した投稿はまとめて書く
+                    group = []
+                    for kind, data in rows:
+                        if kind != "clear":
+                            group.append(json.loads(data))
+                            continue
+                        if group:
+                            store.append_many(group)
+                            index_messages(room_id, group)
+                            group = []
+                        store.write_snapshot([], 1)
+                    if group:
+                        store.append_many(group)
+                        index_messages(room_id, group)
+                    if store.should_snapshot():
+                        store.write_snapshot(room.conversation, room.post_counter)
+                except Exception as e:
+                    print(f"会話ログの保存エラー: {e}")
+                    continue
+                with self._transaction() as conn:
+                    conn.execute("UPDATE rooms SET logged_seq = ? WHERE room_id = ?", (self.last_seq, room_id))
+                    conn.execute(
+                        "DELETE FROM posts WHERE room_id = ? AND seq <= ? AND seq <= "
+                        "(SELECT seq FROM posts WHERE room_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                        (room_id, self.last_seq, room_id, max_len)
+                    )
+
+state_backend = None  # None ならメモリ上の状態のみ (単一プロセス)
+
+def open_state_backend():
+    """config["state_backend"]["type"] が "sqlite" なら共有バックエンドを開く"""
+    global state_backend
+    backend_config = config.get("state_backend", {})
+    if backend_config.get("type", "memory") != "sqlite":
+        return
+    state_backend = SqliteStateBackend(
+        backend_config.get("path", "state.db"),
+        lease_seconds=backend_config.get("LEASE_SECONDS", 15),
+        poll_interval=backend_config.get("POLL_INTERVAL", 0.5)
+    )
 
 ###############################################################################
 # 4. Chatクラス (LLM呼び出し)
 ###############################################################################
 
-class Chat:
+# (base_url, api_key) ごとに使い回すクライアント。内部のHTTP接続プールもそのまま再利用される
+llm_clients = {}
+llm_clients_lock = threading.Lock()
+
+def get_llm_clients(endpoints):
+    """
+    接続先 (base_url, api_key) ごとのクライアントを返す。既存のものは使い回し、
+    設定から外れた接続先のクライアントはプールから外す (実行中の呼び出しが終われば解放される)。
+    """
+    with llm_clients_lock:
+        for key in list(llm_clients):
+            if key not in endpoints:
+                del llm_clients[key]
+        for key in endpoints:
+            if key not in llm_clients:
+                llm_clients[key] = OpenAI(base_url=key[0], api_key=key[1])
+        return [llm_clients[key] for key in endpoints]
+
+class LLMBackend:
+    """振り分け先のLLMサーバー1台分の設定と状態"""
+    def __init__(self, name, base_url, api_key, model, models, weight, max_concurrency, client):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.models = models
+        self.weight = weight
+        self.max_concurrency = max_concurrency  # 0 なら無制限
+        self.client = client
+        self.outstanding = 0      # 実行中のリクエスト数
+        self.sent = 0             # 送ったリクエストの総数 (同点のときに重みどおり順に回すため)
+        self.failures = 0         # 連続失敗回数
+        self.ejected_until = 0.0  # この時刻まで切り離し中
+
+class BackendPool:
+    """
+    複数のLLMサーバーへの振り分け。
+    - 候補のうち、実行中のリクエスト数を重みで割った値が最も小さいサーバーへ送る (最小未処理数)。
+      同点なら送った総数を重みで割った値が小さい方 (空いているときも重みの比で順に回る)
+    - サーバーごとの同時実行数の上限に達していれば、どれかが空くまで待つ
+    - FAILURE_THRESHOLD 回続けて失敗 (タイムアウト・エラー) したサーバーは EJECT_SECONDS 秒切り離す。
+      期間が過ぎたら次のリクエストで試し、成功すれば戻す (1回でも失敗すればまた切り離す)。
+      HEALTH_CHECK_INTERVAL 秒ごとに切り離し中のサーバーへ /models を問い合わせ、応答があれば早めに戻す
+    - 候補がすべて切り離し中なら、最も早く戻る予定のサーバーへ送る (すべて止めるよりは試す)
+    設定の再読み込みでは configure で (名前, base_url) ごとに突き合わせ、残ったサーバーの状態は引き継ぐ。
+    """
+    def __init__(self, chat_config):
+        self.cond = threading.Condition()
+        self.backends = []
+        self.checker = None
+        self.configure(chat_config)
+
+    def configure(self, chat_config):
+        """
+        設定に合わせてサーバーの一覧を作り直す。(名前, base_url) が同じサーバーは同じものとして
+        実行中の数・連続失敗・切り離しを引き継ぎ、モデル・重み・上限などの設定だけ入れ替える。
+        外れたサーバーへの実行中のリクエストは、終わればそのまま捨てられる。
+        """
+        default_model = chat_config.get("model", "gemma2")
+        default_key = chat_config.get("api_key", "ollama")
+        entries = chat_config.get("backends") or [
+            {"name": "default", "base_url": chat_config.get("base_url", "http://localhost:11434/v1")}
+        ]
+        endpoints = [(e["base_url"], e.get("api_key", default_key)) for e in entries]
+        clients = get_llm_clients(endpoints)
+        if len(entries) > 1:
+            # 再試行は別のサーバーで行うので、同じサーバーへの自動再試行はしない (接続プールは共有される)
+            clients = [client.with_options(max_retries=0) for client in clients]
+        with self.cond:
+            self.failure_threshold = max(1, int(chat_config.get("FAILURE_THRESHOLD", 3)))
+            self.eject_seconds = chat_config.get("EJECT_SECONDS", 30)
+            self.check_interval = chat_config.get("HEALTH_CHECK_INTERVAL", 10)
+            current = {(b.name, b.base_url): b for b in self.backends}
+            backends = []
+            for i, (entry, client) in enumerate(zip(entries, clients)):
+                name = entry.get("name") or f"backend{i + 1}"
+                model = entry.get("model", default_model)
+                models = entry.get("models") or [model]
+                weight = max(float(entry.get("weight", 1)), 0.01)
+                max_concurrency = int(entry.get("max_concurrency", 0))
+                backend = current.get((name, entry["base_url"]))
+                if backend is None:
+                    backend = LLMBackend(name, entry["base_url"], endpoints[i][1], model, models,
+                                         weight, max_concurrency, client)
+                else:
+                    backend.api_key = endpoints[i][1]
+                    backend.model = model
+                    backend.models = models
+                    backend.weight = weight
+                    backend.max_concurrency = max_concurrency
+                    backend.client = client
+                backends.append(backend)
+            self.backends = backends
+            # 上限が緩んだかもしれないので、待っているリクエストに選び直させる
+            self.cond.notify_all()
+            start_checker = (len(self.backends) > 1 and self.check_interval > 0
+                             and (self.checker is None or not self.checker.is_alive()))
+            if start_checker:
+                self.checker = threading.Thread(target=self._health_check_loop, daemon=True)
+        if start_checker:
+            self.checker.start()
+
+    def _candidates(self, model=None, backend=None, exclude=()):
+        """ピン留め (サーバー名 / モデル) に合うサーバー。モデルを持つサーバーが無ければ全サーバー"""
+        backends = [b for b in self.backends if b not in exclude]
+        if backend:
+            return [b for b in backends if b.name == backend]
+        if model:
+            return [b for b in backends if model in b.models] or backends
+        return backends
+
+    def candidate_models(self, model=None, backend=None):
+        """送り先の候補で使われるモデル名 (重複なし)。model の指定があればそれだけ"""
+        if model:
+            return [model]
+        with self.cond:
+            return list(dict.fromkeys(b.model for b in self._candidates(model, backend)))
+
+    def acquire(self, model=None, backend=None, exclude=(), timeout=60):
+        """
+        送り先のサーバーを1台選んで実行中の数に加える。候補が無ければ None。
+        同時実行数の上限で空きが無いときは timeout 秒まで待つ。
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                candidates = self._candidates(model, backend, exclude)
+                if not candidates:
+                    return None
+                now = time.time()
+                available = [b for b in candidates if b.max_concurrency <= 0 or b.outstanding < b.max_concurrency]
+                healthy = [b for b in available if b.ejected_until <= now]
+                if healthy:
+                    chosen = min(healthy, key=lambda b: ((b.outstanding + 1) / b.weight, b.sent / b.weight))
+                elif available and all(b.ejected_until > now for b in candidates):
+                    chosen = min(available, key=lambda b: b.ejected_until)
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+                    continue
+                chosen.outstanding += 1
+                chosen.sent += 1
+                return chosen
+
+    def release(self, backend, ok):
+        """リクエストの終了を記録し、連続失敗が続いたサーバーを切り離す (ok が None なら成否は数えない)"""
+        with self.cond:
+            backend.outstanding -= 1
+            if ok:
+                backend.failures = 0
+                backend.ejected_until = 0.0
+            elif ok is not None:
+                backend.failures += 1
+                if backend.failures >= self.failure_threshold:
+                    if backend.ejected_until <= time.time():
+                        print(f"LLMサーバー {backend.name} ({backend.base_url}) を {self.eject_seconds} 秒切り離します。")
+                    backend.ejected_until = time.time() + self.eject_seconds
+            self.cond.notify_all()
+
+    def status(self):
+        now = time.time()
+        with self.cond:
+            return [{
+                "name": b.name, "base_url": b.base_url, "models": list(b.models), "weight": b.weight,
+                "outstanding": b.outstanding, "failures": b.failures, "healthy": b.ejected_until <= now
+            } for b in self.backends]
+
+    def _health_check_loop(self):
+        while self.check_interval > 0:
+            time.sleep(self.check_interval)
+            now = time.time()
+            with self.cond:
+                ejected = [b for b in self.backends if b.ejected_until > now]
+            for b in ejected:
+                try:
+                    b.client.models.list(timeout=5)
+                except Exception:
+                    continue
+                with self.cond:
+                    print(f"LLMサーバー {b.name} ({b.base_url}) が応答したので戻します。")
+                    b.failures = 0
+                    b.ejected_until = 0.0
+                    self.cond.notify_all()
+
+class ResponseCache:
+    """
+    LLM応答のキャッシュ。(接続先, モデル, メッセージ列, パラメータ) のハッシュをキーにします。
+    - max_entries 件を超えたら最も使われていないものから捨てる (LRU)、ttl 秒を過ぎたものは使わない
+    - path を指定すると追記形式のJSONLに保存し、起動時に読み戻す (件数の倍を超えたら書き直す)
+    - hits / misses で命中状況を数える
+    """
     def __init__(self):
-        load_config()  # 最新のconfigを毎回読み込む
-        self.model = config["chat"].get("model", "gemma2")
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (保存時刻, 応答テキスト)
+        self.max_entries = 256
+        self.ttl = 3600
+        self.path = None
+        self.persisted_lines = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(base_url, model, msgs, params=None):
+        data = json.dumps([base_url, model, msgs, params or {}], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def configure(self, max_entries=256, ttl=3600, path=None):
+        with self.lock:
+            self.max_entries = max(1, int(max_entries))
+            self.ttl = float(ttl or 0)
+            if path and path != self.path:
+                self.path = path
+                self._load()
+            elif not path:
+                self.path = None
+            self._evict()
+
+    def _expired(self, stored_at, now):
+        return self.ttl > 0 and now - stored_at > self.ttl
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry[0], time.time()):
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, text):
+        now = time.time()
+        with self.lock:
+            self.entries[key] = (now, text)
+            self.entries.move_to_end(key)
+            self._evict()
+            if self.path:
+                self._persist(key, now, text)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def _load(self):
+        self.persisted_lines = 0
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.persisted_lines += 1
+                    if not self._expired(record["time"], now):
+                        self.entries[record["key"]] = (record["time"], record["text"])
+                        self.entries.move_to_end(record["key"])
+        except OSError as e:
+            print(f"応答キャッシュの読み込みエラー: {e}")
+
+    def _persist(self, key, stored_at, text):
+        try:
+            if self.persisted_lines >= 2 * self.max_entries:
+                # 追記が溜まったら現在の内容だけで書き直す
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for k, (t, v) in self.entries.items():
+                        f.write(json.dumps({"key": k, "time": t, "text": v}, ensure_ascii=False) + "\n")
+                os.replace(tmp_path, self.path)
+                self.persisted_lines = len(self.entries)
+                return
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "time": stored_at, "text": text}, ensure_ascii=False) + "\n")
+            self.persisted_lines += 1
+        except OSError as e:
+            print(f"応答キャッシュの保存エラー: {e}")
+
+response_cache = ResponseCache()
+
+class Chat:
+    def __init__(self, pool=None):
+        """pool を渡すと (設定の再読み込み時)、そのサーバーの状態を引き継いで設定だけ合わせる"""
         self.system = config["chat"].get("system", "あなたは会話エージェントです。")
-        base_url = config["chat"].get("base_url", "http://localhost:11434/v1")
-        api_key = config["chat"].get("api_key", "ollama")
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        if pool is None:
+            pool = BackendPool(config["chat"])
+        else:
+            pool.configure(config["chat"])
+        self.pool = pool
+        self.config_version = config_version
+        cache_config = config.get("llm_cache", {})
+        self.use_cache = cache_config.get("enabled", True)
+        if self.use_cache:
+            response_cache.configure(
+                max_entries=cache_config.get("MAX_ENTRIES", 256),
+                ttl=cache_config.get("TTL", 3600),
+                path=cache_config.get("path") or None
+            )
 
-    def __call__(self, user_message, system_override=None):
+    def _messages(self, user_message, system_override=None):
         sys_msg = system_override or self.system
         msgs = [{"role": "system", "content": sys_msg}] if sys_msg else []
         msgs.append({"role": "user", "content": user_message})
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=msgs,
-                timeout=60
-            )
-            text = response.choices[0].message.content
-            return re.sub(r'<[^>]+>.*?</[^>]+>', '', text, flags=re.DOTALL) 
-        except Exception as e:
-            return f"エラー: {str(e)}"
-
-chat_instance = Chat()
+        return msgs
+
+    def __call__(self, user_message, system_override=None, use_cache=True, kind="summary"):
+        """単発の問い合わせ (要約など)。同じ入力なら応答キャッシュを使う"""
+        return self.complete(self._messages(user_message, system_override), use_cache=use_cache, kind=kind)
+
+    def _backends(self, agent):
+        """
+        送り先のサーバーを1台ずつ確保して (サーバー, モデル名) を返すジェネレータ。
+        失敗したら呼び出し側が次を取り出し、まだ試していないサーバーで再試行する。
+        """
+        model = agent.get("model") if agent else None
+        pinned = agent.get("backend") if agent else None
+        tried = []
+        while True:
+            backend = self.pool.acquire(model, pinned, exclude=tried)
+            if backend is None:
+                return
+            tried.append(backend)
+            yield backend, model or backend.model
+
+    def complete(self, msgs, use_cache=False, kind="agent", agent=None):
+        """
+        組み立て済みのメッセージ列で応答を取得。
+        エージェントの投稿は毎回新しい応答が欲しいので既定ではキャッシュを使わない。
+        kind はメトリクスの分類 (agent / summary)。agent を渡すとそのモデル・サーバーの指定に従う。
+        失敗したら別のサーバーで再試行し、すべて失敗したらエラー文を返す。
+        """
+        use_cache = use_cache and self.use_cache
+        pinned = (agent or {}).get("backend", "")
+        if use_cache:
+            # サーバーを確保する前に、送る可能性のあるモデルごとのキーで引く (空きを待たず、送信数も数えない)
+            for model in self.pool.candidate_models((agent or {}).get("model"), pinned):
+                cached = response_cache.get(ResponseCache.make_key(pinned, model, msgs))
+                if cached is not None:
+                    return cached
+        error = "利用できるLLMサーバーがありません"
+        for backend, model in self._backends(agent):
+            start = time.perf_counter()
+            try:
+                response = backend.client.chat.completions.create(
+                    model=model,
+                    messages=msgs,
+                    timeout=60
+                )
+                text = strip_tags(response.choices[0].message.content)
+            except Exception as e:
+                self.pool.release(backend, ok=False)
+                record_llm_error(model, kind, e, backend.name)
+                error = str(e)
+                continue
+            self.pool.release(backend, ok=True)
+            record_llm_call(model, kind, msgs, text, time.perf_counter() - start, backend.name)
+            # エラー応答はキャッシュしない。キーは実際に送ったモデルで作る
+            if use_cache:
+                response_cache.put(ResponseCache.make_key(pinned, model, msgs), text)
+            return text
+        return f"エラー: {error}"
+
+    def stream(self, msgs, kind="agent", agent=None):
+        """
+        stream=True で応答を受け取り、届いた差分テキストを順に返すジェネレータ。
+        最初の差分が届く前に失敗した場合だけ、別のサーバーで再試行する。
+        """
+        error = RuntimeError("利用できるLLMサーバーがありません")
+        for backend, model in self._backends(agent):
+            start = time.perf_counter()
+            text = ""
+            ok = None  # 途中で読むのをやめられた場合は成否を記録しない
+            try:
+                response = backend.client.chat.completions.create(
+                    model=model,
+                    messages=msgs,
+                    timeout=60,
+                    stream=True
+                )
+                for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        text += chunk.choices[0].delta.content
+                        yield chunk.choices[0].delta.content
+                ok = True
+            except Exception as e:
+                ok = False
+                record_llm_error(model, kind, e, backend.name)
+                if text:
+                    raise
+                error = e
+                continue
+            finally:
+                self.pool.release(backend, ok)
+            record_llm_call(model, kind, msgs, text, time.perf_counter() - start, backend.name)
+            return
+        raise error
+
+def record_llm_call(model, kind, msgs, text, elapsed, backend="default"):
+    """LLM呼び出し1回分の所要時間・入出力のトークン数 (概算)・生成速度を記録"""
+    prompt_tokens = sum(estimate_tokens(m["content"]) for m in msgs)
+    response_tokens = estimate_tokens(text)
+    metrics.observe("autochat_llm_request_seconds", elapsed, model=model, kind=kind, backend=backend)
+    metrics.observe("autochat_llm_prompt_tokens", prompt_tokens, model=model, kind=kind)
+    metrics.observe("autochat_llm_response_tokens", response_tokens, model=model, kind=kind)
+    metrics.inc("autochat_llm_tokens_total", prompt_tokens, model=model, kind=kind, direction="prompt")
+    metrics.inc("autochat_llm_tokens_total", response_tokens, model=model, kind=kind, direction="response")
+    if elapsed > 0:
+        metrics.observe("autochat_llm_tokens_per_second", response_tokens / elapsed, model=model, kind=kind)
+
+def record_llm_error(model, kind, error, backend="default"):
+    error_type = "timeout" if "timeout" in type(error).__name__.lower() else "error"
+    metrics.inc("autochat_llm_errors_total", model=model, kind=kind, type=error_type, backend=backend)
+
+def strip_tags(text):
+    """<think>…</think> のようなタグ付きブロックを取り除く"""
+    return re.sub(r'<[^>]+>.*?</[^>]+>', '', text, flags=re.DOTALL)
+
+def strip_tags_partial(text):
+    """生成途中のテキスト用。閉じていないタグ以降と書きかけのタグも表示しない"""
+    text = strip_tags(text)
+    text = re.sub(r'<[^>/][^>]*>.*\Z', '', text, flags=re.DOTALL)
+    return re.sub(r'<[^>]*\Z', '', text)
+
+chat_instance = None
+
+def get_chat():
+    """
+    現在の設定に対応するChatを返す。設定が変わったときだけ作り直す。
+    サーバーの振り分け (BackendPool) は作り直さず、設定に合わせて引き継ぐ。
+    """
+    global chat_instance
+    if chat_instance is None or chat_instance.config_version != config_version:
+        chat_instance = Chat(chat_instance.pool if chat_instance is not None else None)
+    return chat_instance
 
 ###############################################################################
 # 5. 自動要約設定
 ###############################################################################
 AUTO_SUMMARY_INTERVAL = 10  # 10件ごとにまとめ自動更新
-messages_since_last_summary = 0
-
-def generate_summary():
-    """直近の会話をLLMで要約し、thread_config["summary"]に反映"""
-    global thread_config
-    # 直近50件程度を対象に
-    recent_msgs = conversation[-AUTO_SUMMARY_INTERVAL:]
-    conversation_text = ""
-    for msg in recent_msgs:
-        conversation_text += f"{msg['number']}. {msg['agent']}"
+SUMMARY_SYSTEM = "あなたは優秀な議論の要約者です。"
+
+class SummaryChunkStore:
+    """
+    区切りごとの要約の保存先 (ルームの会話ストアに置くJSONL)。
+    キーは要約に使ったプロンプトのハッシュなので、同じ内容の区切りは二度と要約しません。
+    """
+    FILE_NAME = "summary_chunks.jsonl"
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.lock = threading.Lock()
+        self.summaries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.summaries[record["key"]] = record["summary"]
+
+    def get(self, key):
+        return self.summaries.get(key)
+
+    def put(self, key, summary):
+        with self.lock:
+            self.summaries[key] = summary
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key, "summary": summary}, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"要約キャッシュの保存エラー: {e}")
+
+def format_messages_for_summary(messages):
+    text = ""
+    for msg in messages:
+        text += f"{msg['number']}. {msg['agent']}"
         if msg['reply_to']:
-            conversation_text += f" (>>{msg['reply_to']})"
-        conversation_text += f": {msg['text']}\n"
-
-    prompt = (
-        "以下はこれまでの会話の要約です。"
-        + thread_config["summary"]
-        + "\n以下は直近の会話です。これをこれまでの要約にマージし、論点や結論を整理してください。\n\n"
-        + conversation_text
-        + "以下はスレッドタイトルです。このタイトルに従って整理して下さい。"
+            text += f" (>>{msg['reply_to']})"
+        text += f": {msg['text']}\n"
+    return text
+
+def read_conversation(room, first, last):
+    """
+    現在の会話の first〜last 番を返す。会話ストアから読み、読めなかった分はメモリ上の会話で補う
+    (古いセグメントを削除している場合など)。
+    書き込みスレッドに残っている投稿は先にログへ出す (メモリ上の会話より古い投稿を読み落とさないため)。
+    """
+    if room.message_store is not None:
+        persistence_writer.flush()
+    try:
+        messages = log_reader(room).read_range(first, last)
+    except (OSError, ValueError) as e:
+        print(f"会話ログの読み出しエラー: {e}")
+        messages = []
+    return merge_memory_posts(room, messages, first, last)
+
+def merge_memory_posts(room, messages, first, last):
+    """ログから読んだ first〜last 番の投稿に、ログに無い分 (書き込み待ちなど) をメモリ上の会話から補って番号順にする"""
+    numbers = {m["number"] for m in messages}
+    messages.extend(m for m in list(room.conversation) if first <= m["number"] <= last and m["number"] not in numbers)
+    messages.sort(key=lambda m: m["number"])
+    return messages
+
+def split_into_chunks(messages, chunk_size, chunk_tokens=0):
+    """
+    会話を要約用の区切りに分け、(投稿のリスト, 確定済みか) の列を返す。
+    chunk_tokens > 0 ならトークン数 (概算) で、そうでなければ chunk_size 件で区切る。
+    先頭から貪欲に区切るので、投稿が増えても確定済みの区切りの境界は変わらない。
+    """
+    if chunk_tokens <= 0:
+        return [(messages[i:i + chunk_size], i + chunk_size <= len(messages))
+                for i in range(0, len(messages), chunk_size)]
+    chunks, current, used = [], [], 0
+    for msg in messages:
+        cost = message_tokens(msg) + estimate_tokens(msg["agent"]) + MESSAGE_OVERHEAD_TOKENS
+        if current and used + cost > chunk_tokens:
+            chunks.append((current, True))
+            current, used = [], 0
+        current.append(msg)
+        used += cost
+    if current:
+        chunks.append((current, False))
+    return chunks
+
+def summarize_prompt(chunk_store, prompt, persist):
+    """
+    プロンプト1つ分を要約する。persist=True (確定した区切り) なら結果をルームの要約キャッシュに残し、
+    次回からはLLMを呼ばない。失敗した要約は保存せず例外にする。
+    """
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    cached = chunk_store.get(key)
+    if cached is not None:
+        return cached
+    result = get_chat()(prompt, system_override=SUMMARY_SYSTEM).strip()
+    if result.startswith("エラー:"):
+        raise RuntimeError(result)
+    if persist:
+        chunk_store.put(key, result)
+    return result
+
+def generate_summary(room):
+    """
+    会話全体を階層的に要約し、thread_config["summary"]に反映。
+    - 会話を SUMMARY_CHUNK_SIZE 件ずつ区切って並列に要約 (map)
+    - 要約を SUMMARY_FANOUT 個ずつまとめて要約し直し、1段ずつ上へ畳み込む (reduce)
+    - 件数の揃った区切りの要約は投稿番号の範囲ごとに room.summary_progress に覚え、
+      会話ストアからは最後に確定した区切りの次の投稿以降だけを読む
+    - 件数の揃った区切り・グループの要約は内容のハッシュでも保存し、再起動後も再計算しない
+    最後の1回だけスレッドタイトルを渡して整理させます。
+    """
+    thread_config = room.thread_config
+    # 前回の要約から投稿・タイトル・まとめが変わっていなければ、要約し直しても同じ結果になるので省く
+    basis = (room.conversation_epoch, room.post_counter, thread_config["title"])
+    if room.summary_basis == basis + (thread_config["summary"],):
+        return
+    conversation_config = config["conversation"]
+    chunk_size = max(1, int(conversation_config.get("SUMMARY_CHUNK_SIZE", 50)))
+    fanout = max(2, int(conversation_config.get("SUMMARY_FANOUT", 8)))
+    concurrency = max(1, int(conversation_config.get("SUMMARY_CONCURRENCY", 4)))
+    if room.summary_chunks is None:
+        room.summary_chunks = SummaryChunkStore(room_store_dir(room.room_id))
+
+    chunk_tokens = int(conversation_config.get("SUMMARY_CHUNK_TOKENS", 0) or 0)
+    # クリアされたり区切り方が変わったりしていれば、確定済みの区切りは使えない
+    progress = room.summary_progress
+    finalized = []
+    if progress is not None and progress[:2] == (basis[0], (chunk_size, chunk_tokens)):
+        finalized = list(progress[2])
+    start = finalized[-1][1] + 1 if finalized else 1
+    messages = read_conversation(room, start, room.post_counter - 1)
+    if not messages and not finalized:
+        return
+    title_instruction = (
+        "以下はスレッドタイトルです。このタイトルに従って整理して下さい。"
         + thread_config["title"]
         + "\n[要約出力]:"
     )
-    result = chat_instance(prompt, system_override="あなたは優秀な議論の要約者です。")
-    thread_config["summary"] = result.strip()
-
-def on_new_message_posted():
+    # 区切りは先頭から貪欲に作るので、確定済みの境界から区切り直しても同じ区切りになる
+    chunks = split_into_chunks(messages, chunk_size, chunk_tokens)
+    if not finalized and len(chunks) == 1:
+        # 1区切りに収まる間は1回の呼び出しで済ませる
+        summary = summarize_prompt(room.summary_chunks, (
+            "以下は会話です。論点や結論を整理して要約してください。\n\n"
+            + format_messages_for_summary(chunks[0][0])
+            + title_instruction
+        ), persist=False)
+    else:
+        # (プロンプト, 確定済みか) の列を段ごとに要約する。最後の区切りは投稿が増えるので確定扱いにしない
+        level = [(
+            "以下は会話の一部です。論点・主張・結論を簡潔に要約してください。\n\n"
+            + format_messages_for_summary(chunk)
+            + "[要約出力]:",
+            complete
+        ) for chunk, complete in chunks]
+        extra = room_scheduler.try_acquire(concurrency - 1)
+        try:
+            with ThreadPoolExecutor(max_workers=1 + extra, thread_name_prefix="summary") as pool:
+                # 確定済みの区切りは覚えている要約を使い、新しい区切りだけを要約する
+                new_summaries = list(pool.map(lambda item: summarize_prompt(room.summary_chunks, *item), level))
+                for (chunk, complete), summary in zip(chunks, new_summaries):
+                    if complete:
+                        finalized.append((chunk[0]["number"], chunk[-1]["number"], summary))
+                room.summary_progress = (basis[0], (chunk_size, chunk_tokens), finalized)
+                summaries = [summary for _, _, summary in finalized]
+                summaries += [summary for (_, complete), summary in zip(chunks, new_summaries) if not complete]
+                done = [True] * len(finalized) + [False] * (len(summaries) - len(finalized))
+                while True:
+                    # トークン予算がある場合は、最後の1回に渡す要約の合計も予算に収まるまで畳み込む
+                    total = sum(estimate_tokens(summary) for summary in summaries)
+                    if len(summaries) <= fanout and (chunk_tokens <= 0 or total <= chunk_tokens or len(summaries) == 1):
+                        break
+                    level = []
+                    for i in range(0, len(summaries), fanout):
+                        group = summaries[i:i + fanout]
+                        level.append((
+                            "以下は会話を順に区切って要約したものです。重複をまとめ、論点・主張・結論を簡潔に1つの要約にしてください。\n\n"
+                            + "\n\n".join(group)
+                            + "\n[要約出力]:",
+                            len(group) == fanout and all(done[i:i + fanout])
+                        ))
+                    summaries = list(pool.map(lambda item: summarize_prompt(room.summary_chunks, *item), level))
+                    done = [persist for _, persist in level]
+        finally:
+            room_scheduler.release(extra)
+        summary = summarize_prompt(room.summary_chunks, (
+            "以下は会話を順に区切って要約したものです。これらを1つにまとめ、論点や結論を整理してください。\n\n"
+            + "\n\n".join(summaries)
+            + "\n"
+            + title_instruction
+        ), persist=False)
+    # 完成した要約を一度の代入で差し替える (読み手が書きかけを見ることはない)
+    update_thread_config(room, lambda room: room.thread_config.update(summary=summary))
+    room.summary_basis = basis + (summary,)
+
+class SummaryJob:
+    """
+    要約生成をバックグラウンドで実行するジョブ。
+    - 同時に実行されるのは常に1本だけ
+    - 実行中に届いた要求は、次の1回の実行にまとめて集約する
+    - request() が返すチケットで、その要求を反映した実行の完了を待てる
+    """
+    def __init__(self, target):
+        self.target = target
+        self.cond = threading.Condition()
+        self.requested = 0  # 受け付けた要求の通し番号
+        self.completed = 0  # 完了した実行が反映済みの要求番号
+        self.thread = None
+
+    def request(self):
+        with self.cond:
+            self.requested += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+            return self.requested
+
+    def wait(self, ticket, timeout=None):
+        """チケットの要求を含む実行が終わるまで待つ。タイムアウトしたら False"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.completed >= ticket, timeout)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.requested > self.completed)
+                target = self.requested
+            try:
+                self.target()
+            except Exception as e:
+                print(f"要約生成エラー: {e}")
+            with self.cond:
+                self.completed = target
+                self.cond.notify_all()
+
+def on_new_message_posted(room):
     """
     新しいメッセージが投稿された後に呼び出されるフック。
-    - カウンタを進めてAUTO_SUMMARY_INTERVALに達したら自動で要約生成
+    - カウンタを進めてAUTO_SUMMARY_INTERVALに達したら要約ジョブを依頼 (完了は待たない)
     """
-    global messages_since_last_summary
-    messages_since_last_summary += 1
-    if messages_since_last_summary >= AUTO_SUMMARY_INTERVAL:
-        generate_summary()
-        messages_since_last_summary = 0
+    with room.summary_trigger_lock:
+        room.messages_since_last_summary += 1
+        if room.messages_since_last_summary < AUTO_SUMMARY_INTERVAL:
+            return
+        room.messages_since_last_summary = 0
+    room.summary_job.request()
 
 ###############################################################################
 # 6. Flaskアプリ設定
@@ -230,89 +2702,613 @@ app = Flask(__name__)
 app.secret_key = "secret_key_for_session"
 
 load_config()
-load_conversation()
+open_history_index()
+open_state_backend()
+load_rooms()
+# 終了時に書き込みスレッドの列に残った投稿を書き切る
+atexit.register(persistence_writer.flush, 10)
+if state_backend:
+    @app.before_request
+    def sync_shared_state():
+        """他のワーカーが書き込んだ投稿・設定を取り込んでから応答する"""
+        state_backend.sync_if_changed()
 
 ###############################################################################
 # 7. バックグラウンド会話ワーカー (エージェント投稿)
 ###############################################################################
 
-def conversation_worker():
-    global conversation, post_counter
-    while True:
-        # エージェントがいなければスキップ
-        if not thread_config["agents"]:
-            time.sleep(2)
+MESSAGE_OVERHEAD_TOKENS = 4  # role や区切りなど、メッセージ1件あたりに加わる分の概算
+
+def build_prompt_prefix(room, agent):
+    """
+    プロンプトの固定部分 (system + タイトル + 性格 + 投稿ルール) と、まとめを (メッセージ列, 概算トークン数) で返す。
+    ターンをまたいで同じ文字列になるため、バックエンド側のKVキャッシュを再利用できる。
+    CONTEXT_TOKEN_BUDGET が指定されていれば、まとめは予算の SUMMARY_TOKEN_SHARE までに切り詰める。
+    """
+    thread_config = room.thread_config
+    key = (room.thread_config_version, config_version, agent["name"], agent["personality"])
+    cached = room.prompt_prefix_cache.get(agent["id"])
+    if cached and cached[0] == key:
+        return cached[1], cached[2]
+
+    system = config["chat"].get("system", "あなたは会話エージェントです。")
+    prompt_instructions = config.get("prompt_instructions", "")
+    prefix = system + "\n"
+    if thread_config["title"]:
+        prefix += f"このスレッドのタイトルは「{thread_config['title']}」です。\n"
+    prefix += f"あなたは {agent['name']}。性格は {agent['personality']}です。\n"
+    if thread_config["title"]:
+        prefix += "タイトルに配慮した発言を心がけてください。\n"
+    prefix += "\n" + prompt_instructions
+    messages = [{"role": "system", "content": prefix}]
+
+    # まとめがある場合も、エージェントが参照できるように固定部分の直後に置く
+    summary_text = thread_config["summary"].strip()
+    budget = int(config["conversation"].get("CONTEXT_TOKEN_BUDGET", 0) or 0)
+    if summary_text and budget:
+        share = config["conversation"].get("SUMMARY_TOKEN_SHARE", 0.5)
+        limit = int((budget - estimate_tokens(prefix)) * share)
+        summary_text = truncate_to_tokens(summary_text, limit) if limit > 0 else ""
+    if summary_text:
+        messages.append({"role": "system", "content": f"現在のまとめ(要約)があります。参考にしてください:\n{summary_text}"})
+
+    tokens = sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+    room.prompt_prefix_cache[agent["id"]] = (key, messages, tokens)
+    return messages, tokens
+
+def select_recent_messages(conversation, context_window, budget):
+    """
+    プロンプトに載せる直近の投稿を選ぶ。
+    budget > 0 なら新しい方から投稿ごとの保存済みトークン数を足し、予算に収まる分だけ (選んだ件数に比例)。
+    それ以外は CONTEXT_WINDOW 件。
+    """
+    if budget <= 0:
+        return conversation[-context_window:] if len(conversation) >= context_window else conversation
+    start = len(conversation)
+    used = 0
+    while start > 0:
+        msg = conversation[start - 1]
+        # 番号・名前の見出し分を加える
+        cost = message_tokens(msg) + estimate_tokens(msg["agent"]) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    if start == len(conversation) and conversation:
+        # 最新の1件だけで予算を超える場合は、その本文を切り詰めて載せる
+        last = dict(conversation[-1])
+        last["text"] = truncate_to_tokens(last["text"], budget - estimate_tokens(last["agent"]) - MESSAGE_OVERHEAD_TOKENS)
+        return [last]
+    return conversation[start:]
+
+def build_agent_messages(room, agent):
+    """
+    エージェント1人分のメッセージ列を作成。
+    固定部分の後ろに直近の書き込みを並べ、本人の過去投稿は assistant、それ以外は user とする。
+    """
+    context_window = config["conversation"].get("CONTEXT_WINDOW", 10)
+    budget = int(config["conversation"].get("CONTEXT_TOKEN_BUDGET", 0) or 0)
+    prefix, prefix_tokens = build_prompt_prefix(room, agent)
+    request_line = f"{agent['name']} として次の投稿を書いてください。"
+
+    # 直近の書き込み (トークン予算があれば、固定部分と依頼文を除いた残りに収める)
+    if budget:
+        budget = max(1, budget - prefix_tokens - estimate_tokens(request_line) - MESSAGE_OVERHEAD_TOKENS)
+    # トークン予算で選ぶときは件数で切らず、メモリ上の会話全体から選ぶ
+    recent = select_recent_messages(room.conversation.tail(None if budget else context_window), context_window, budget)
+
+    messages = list(prefix)
+    for msg in recent:
+        if msg["agent"] == agent["name"]:
+            messages.append({"role": "assistant", "content": msg["text"]})
             continue
+        if msg.get("reply_to"):
+            line = f"{msg['number']}. {msg['agent']} (返信先: {msg['reply_to']}): {msg['text']}"
+        else:
+            line = f"{msg['number']}. {msg['agent']}: {msg['text']}"
+        if messages[-1]["role"] == "user":
+            messages[-1] = {"role": "user", "content": messages[-1]["content"] + "\n" + line}
+        else:
+            messages.append({"role": "user", "content": line})
 
-        for agent in thread_config["agents"]:
-            # configを再読込(例えばCONTEXT_WINDOWなどが変わったら即反映)
-            load_config()
-            chat = Chat()
-
-            context_window = config["conversation"].get("CONTEXT_WINDOW", 10)
-            prompt_instructions = config.get("prompt_instructions", "")
-            max_len = config["conversation"].get("MAX_CONVERSATION_LENGTH", 100)
-
-            # 直近の書き込み
-            recent = conversation[-context_window:] if len(conversation) >= context_window else conversation
-
-            # まとめがある場合も、エージェントが参照できるように追加
-            summary_text = thread_config["summary"].strip()
-            # プロンプト作成
-            prompt = ""
-            if thread_config["title"]:
-                prompt += f"このスレッドのタイトルは「{thread_config['title']}」です。\n"
-            if summary_text:
-                prompt += f"現在のまとめ(要約)があります。参考にしてください:\n{summary_text}\n\n"
-            prompt += f"あなたは {agent['name']}。性格は {agent['personality']}です。\n"
-            if thread_config["title"]:
-                prompt += "タイトルに配慮した発言を心がけてください。\n"
-            prompt += "以下、直近の書き込みです。\n"
-            for msg in recent:
-                if msg.get("reply_to"):
-                    prompt += f"{msg['number']}. {msg['agent']} (返信先: {msg['reply_to']}): {msg['text']}\n"
-                else:
-                    prompt += f"{msg['number']}. {msg['agent']}: {msg['text']}\n"
-            prompt += "\n" + prompt_instructions
-
-            response_text = chat(prompt).strip()
-            if response_text:
-                # 返信先を抽出
-                valid_names = {a['name'] for a in thread_config["agents"]} | {m['agent'] for m in conversation}
-                reply_to = None
-                if valid_names:
-                    pattern = r'@(' + '|'.join(re.escape(name) for name in valid_names) + r')'
-                    match = re.search(pattern, response_text)
-                    if match:
-                        reply_to = match.group(1)
-                        response_text = response_text.replace("@" + reply_to, "").strip()
-
-                response_text = response_text.split('@')[0]
-                new_msg = {
-                    "number": post_counter,
+    if messages[-1]["role"] == "user":
+        messages[-1] = {"role": "user", "content": messages[-1]["content"] + "\n\n" + request_line}
+    else:
+        messages.append({"role": "user", "content": request_line})
+    return messages
+
+def extract_reply(room, response_text):
+    """応答文から「@名前」を取り出し、(本文, 返信先) を返す"""
+    reply_to = room.name_matcher.search(response_text)
+    if reply_to:
+        response_text = response_text.replace("@" + reply_to, "").strip()
+
+    response_text = response_text.split('@')[0]
+    return response_text, reply_to
+
+draft_ids = itertools.count(1)
+
+def stream_agent_response(room, agent, messages):
+    """
+    応答をトークン単位で受け取り、生成途中の投稿を下書きとして配信する。
+    (下書きID, 完成した応答文) を返す。
+    """
+    draft_id = f"d{next(draft_ids)}"
+    interval = config["chat"].get("STREAM_PUBLISH_INTERVAL", 0.2)
+    text = ""
+    last_publish = 0.0
+    try:
+        for delta in get_chat().stream(messages, agent=agent):
+            text += delta
+            now = time.time()
+            visible = strip_tags_partial(text)
+            if visible and now - last_publish >= interval:
+                last_publish = now
+                room.broadcaster.publish("draft", {
+                    "draft": draft_id,
+                    "epoch": room.conversation_epoch,
                     "agent": agent["name"],
-                    "reply_to": reply_to,
-                    "text": response_text,
-                    "timestamp": time.time()
-                }
-                conversation.append(new_msg)
-                post_counter += 1
-                log_message_to_file(new_msg)
-                save_conversation()
+                    "text": visible
+                })
+        text = strip_tags(text)
+    except Exception as e:
+        text = f"エラー: {str(e)}"
+    return draft_id, text
+
+def discard_draft(room, turn):
+    """コミットされなかった生成の下書きを閲覧者の画面から消す"""
+    if turn and turn.get("draft"):
+        room.broadcaster.publish("draft_end", {"draft": turn["draft"]})
+
+def generate_agent_turn(room, agent):
+    """
+    エージェント1人分の投稿を生成する (会話への反映はしない)。
+    生成時点の (epoch, post_counter) を basis として記録し、コミット時の古さ判定に使う。
+    config["chat"]["stream"] が有効なら生成途中の文章を下書きとして逐次配信する。
+    """
+    basis = (room.conversation_epoch, room.post_counter)
+    messages = build_agent_messages(room, agent)
+    draft_id = None
+    if config["chat"].get("stream", False):
+        draft_id, response_text = stream_agent_response(room, agent, messages)
+        response_text = response_text.strip()
+    else:
+        response_text = get_chat().complete(messages, agent=agent).strip()
+    if not response_text:
+        discard_draft(room, {"draft": draft_id})
+        return None
+    text, reply_to = extract_reply(room, response_text)
+    return {"agent": agent, "text": text, "reply_to": reply_to, "basis": basis, "draft": draft_id}
+
+def commit_agent_turn(room, turn):
+    """生成済みの投稿を会話へ反映 (下書きがあれば置き換える)"""
+    return append_message(room, turn["agent"]["name"], turn["text"], turn["reply_to"], turn["draft"])
+
+def is_stale_turn(room, turn, own_numbers, tolerance):
+    """
+    生成開始後に、同じラウンドの投稿以外で tolerance 件を超える新しい投稿があれば古いとみなす。
+    会話がクリアされていれば常に古い。
+    """
+    epoch, basis_counter = turn["basis"]
+    if epoch != room.conversation_epoch:
+        return True
+    newer = room.post_counter - basis_counter
+    newer -= sum(1 for n in own_numbers if n >= basis_counter)
+    return newer > tolerance
+
+def is_active_agent(room, agent):
+    return any(a["id"] == agent["id"] for a in room.thread_config["agents"])
+
+# 同時生成用のスレッドプール。実際の同時実行数はラウンドごとの窓とLLMスロットで制限する
+agent_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="agent")
 
-                # 自動要約判定
-                on_new_message_posted()
+def run_concurrent_round(room, agents, concurrency):
+    """
+    最大 concurrency 人ぶんを同時に生成し、結果はエージェント順にコミットする。
+    古くなった生成は STALE_POLICY に従って扱う (commit_round_turn)。コミットした投稿のリストを返す。
+    """
+    remaining = iter(agents)
+    in_flight = deque()
+
+    def submit_next():
+        agent = next(remaining, None)
+        if agent is not None:
+            in_flight.append((agent, agent_executor.submit(generate_agent_turn, room, agent)))
+
+    for _ in range(concurrency):
+        submit_next()
+    own_numbers = []
+    committed = []
+    while in_flight:
+        agent, future = in_flight.popleft()
+        try:
+            turn = future.result()
+        except Exception as e:
+            print(f"エージェント投稿の生成エラー ({agent['name']}): {e}")
+            submit_next()
+            continue
+        new_msg = commit_round_turn(room, agent, turn, own_numbers)
+        if new_msg is not None:
+            committed.append(new_msg)
+        submit_next()
+    return committed
+
+def commit_round_turn(room, agent, turn, own_numbers):
+    """
+    ラウンド内で生成済みの投稿をコミットし、その投稿を返す (反映しなければ None)。
+    コミットした投稿番号は own_numbers に足す。
+    古くなった生成は STALE_POLICY に従って再生成 (regenerate) / 破棄 (drop) / そのまま採用 (keep)。
+    """
+    stale_policy = config["conversation"].get("STALE_POLICY", "regenerate")
+    tolerance = config["conversation"].get("STALE_TOLERANCE", 0)
+    if turn and is_stale_turn(room, turn, own_numbers, tolerance):
+        if stale_policy == "drop":
+            discard_draft(room, turn)
+            return None
+        if stale_policy == "regenerate":
+            discard_draft(room, turn)
+            turn = generate_agent_turn(room, agent)
+    # 生成中に削除されたエージェントの投稿は反映しない
+    if turn and is_active_agent(room, agent):
+        new_msg = commit_agent_turn(room, turn)
+        own_numbers.append(new_msg["number"])
+        return new_msg
+    discard_draft(room, turn)
+    return None
+
+def build_batch_prefix(room, agents):
+    """
+    一括生成用の固定部分 (system + タイトル + 参加者全員の性格 + 投稿ルール + 出力形式) とまとめ。
+    (メッセージ列, 概算トークン数) を返す。エージェント1人分の build_prompt_prefix と同じくキャッシュする。
+    """
+    thread_config = room.thread_config
+    key = (room.thread_config_version, config_version, tuple((a["name"], a["personality"]) for a in agents))
+    cached = room.prompt_prefix_cache.get("batch")
+    if cached and cached[0] == key:
+        return cached[1], cached[2]
+
+    system = config["chat"].get("system", "あなたは会話エージェントです。")
+    prefix = system + "\n"
+    if thread_config["title"]:
+        prefix += f"このスレッドのタイトルは「{thread_config['title']}」です。タイトルに配慮した発言を心がけてください。\n"
+    prefix += "あなたは次の参加者を演じ分けます。\n"
+    for agent in agents:
+        prefix += f"- {agent['name']}: 性格は {agent['personality']}です。\n"
+    prefix += "\n" + config.get("prompt_instructions", "")
+    prefix += (
+        "\n\n出力は次の形のJSON配列だけにしてください (説明や前置きは書かない)。\n"
+        '[{"agent": "参加者の名前", "text": "その参加者の投稿"}, ...]'
+    )
+    messages = [{"role": "system", "content": prefix}]
+
+    summary_text = thread_config["summary"].strip()
+    budget = int(config["conversation"].get("CONTEXT_TOKEN_BUDGET", 0) or 0)
+    if summary_text and budget:
+        share = config["conversation"].get("SUMMARY_TOKEN_SHARE", 0.5)
+        limit = int((budget - estimate_tokens(prefix)) * share)
+        summary_text = truncate_to_tokens(summary_text, limit) if limit > 0 else ""
+    if summary_text:
+        messages.append({"role": "system", "content": f"現在のまとめ(要約)があります。参考にしてください:\n{summary_text}"})
+
+    tokens = sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+    room.prompt_prefix_cache["batch"] = (key, messages, tokens)
+    return messages, tokens
+
+def build_batch_messages(room, agents):
+    """ラウンド全員分をまとめて生成するメッセージ列。直近の書き込みは1回だけ載せる"""
+    context_window = config["conversation"].get("CONTEXT_WINDOW", 10)
+    budget = int(config["conversation"].get("CONTEXT_TOKEN_BUDGET", 0) or 0)
+    prefix, prefix_tokens = build_batch_prefix(room, agents)
+    names = "、".join(a["name"] for a in agents)
+    request_line = f"{names} の順に、それぞれ1件ずつ次の投稿を書いてください。"
+    if budget:
+        budget = max(1, budget - prefix_tokens - estimate_tokens(request_line) - MESSAGE_OVERHEAD_TOKENS)
+    # トークン予算で選ぶときは件数で切らず、メモリ上の会話全体から選ぶ
+    recent = select_recent_messages(room.conversation.tail(None if budget else context_window), context_window, budget)
+
+    lines = []
+    for msg in recent:
+        if msg.get("reply_to"):
+            lines.append(f"{msg['number']}. {msg['agent']} (返信先: {msg['reply_to']}): {msg['text']}")
+        else:
+            lines.append(f"{msg['number']}. {msg['agent']}: {msg['text']}")
+    lines.append(("\n" if lines else "") + request_line)
+    return list(prefix) + [{"role": "user", "content": "\n".join(lines)}]
 
-                # 長さ制限
-                if len(conversation) > max_len:
-                    conversation = conversation[-max_len:]
-                    save_conversation()
+def parse_batch_response(response_text, agents):
+    """
+    一括生成の応答 (JSON配列) を {エージェント名: 本文} にする。
+    参加者以外・空の本文・2件目以降の同じ参加者は捨てる。配列として読めなければ None。
+    """
+    start, end = response_text.find("["), response_text.rfind("]")
+    if start < 0 or end <= start:
+        return None
+    try:
+        items = json.loads(response_text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(items, list):
+        return None
+    names = {a["name"] for a in agents}
+    texts = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        name, text = item.get("agent"), item.get("text")
+        if name not in names or name in texts or not isinstance(text, str):
+            continue
+        # 「名前:」を付けて書いてしまった場合は外す
+        text = re.sub(r'^\s*' + re.escape(name) + r'\s*[:：]', '', text).strip()
+        if text:
+            texts[name] = text
+    return texts or None
 
-            time.sleep(1)
+def run_batched_round(room, agents):
+    """
+    1回のLLM呼び出しでラウンド全員分の投稿を生成し、エージェント順にコミットする。
+    - 直近の書き込み・タイトル・まとめは1回だけ送るので、プロンプト処理はエージェント数分の1程度になる
+    - 応答が読めなかった場合や、応答に含まれなかったエージェントは1人ずつ生成する
+    - model / backend を指定したエージェントは、指定どおりのモデルで1人ずつ生成する
+    - ストリーミング表示 (chat.stream) は一括生成では行わない
+    - 応答が BATCH_FAILURE_THRESHOLD 回続けて読めなければ、BATCH_COOLDOWN 秒は一括生成をやめる
+      (読めないたびに1回余分な呼び出しが増えるため)
+    """
+    batched = [a for a in agents if not a.get("model") and not a.get("backend")]
+    basis = (room.conversation_epoch, room.post_counter)
+    texts = {}
+    if len(batched) > 1:
+        response_text = get_chat().complete(build_batch_messages(room, batched), kind="batch").strip()
+        if response_text.startswith("エラー:"):
+            # LLMに届かない場合は1人ずつ試しても同じなので、このラウンドは休む
+            print(f"一括生成のエラー: {response_text}")
+            room.error_streak += 1
+            return
+        room.error_streak = 0
+        texts = parse_batch_response(response_text, batched)
+        if texts is None:
+            print("一括生成の応答を読み取れなかったため、1人ずつ生成します。")
+            texts = {}
+            room.batch_failures += 1
+            if room.batch_failures >= int(config["conversation"].get("BATCH_FAILURE_THRESHOLD", 3)):
+                cooldown = config["conversation"].get("BATCH_COOLDOWN", 300)
+                print(f"一括生成の応答が続けて読めなかったため、{cooldown} 秒は1人ずつ生成します。")
+                room.batch_disabled_until = time.time() + cooldown
+                room.batch_failures = 0
+        else:
+            room.batch_failures = 0
+        metrics.inc("autochat_batch_turns_total", len(texts), result="parsed")
+        metrics.inc("autochat_batch_turns_total", len(batched) - len(texts), result="fallback")
+
+    own_numbers = []
+    for agent in agents:
+        if agent["name"] in texts:
+            text, reply_to = extract_reply(room, texts[agent["name"]])
+            turn = {"agent": agent, "text": text, "reply_to": reply_to, "basis": basis, "draft": None}
+        else:
+            turn = generate_agent_turn(room, agent)
+        commit_round_turn(room, agent, turn, own_numbers)
 
-        time.sleep(5)
+def run_room_step(room):
+    """
+    ルームのエージェント投稿を1ステップ進め、次のステップまでの待ち秒数を返す。
+    - 通常: 次のエージェント1人分の投稿 (ラウンドの途中なら AGENT_INTERVAL、終わりなら ROUND_INTERVAL)
+    - AGENT_CONCURRENCY > 1: 空いているLLMスロットを借りて1ラウンド分を同時生成
+    - BATCH_TURNS: 1回のLLM呼び出しで1ラウンド分を一括生成 (応答が続けて読めない間は休む)
+    - ユーザの投稿があれば、「@名前」で指名されたエージェント (無ければ次の順番の人) が先に返信する
+    """
+    # config.jsonが更新されていれば再読込(例えばCONTEXT_WINDOWなどが変わったら即反映)
+    reload_config_if_changed()
+    scheduler_config = config.get("scheduler", {})
+    agent_interval = scheduler_config.get("AGENT_INTERVAL", 1)
+    round_interval = scheduler_config.get("ROUND_INTERVAL", 5)
+    agents = list(room.thread_config["agents"])
+    if not agents:
+        return round_interval
+    # 返信待ちのユーザ投稿はこのステップで扱う (実行中に届いた投稿は次のステップへ)
+    user_msg, room.user_pending = room.user_pending, None
+    reply_agent = pick_reply_agent(room, agents, user_msg)
+
+    batch = (config["conversation"].get("BATCH_TURNS", False) and len(agents) > 1
+             and time.time() >= room.batch_disabled_until)
+    concurrency = max(1, int(config["conversation"].get("AGENT_CONCURRENCY", 1)))
+    if (batch or concurrency > 1) and reply_agent is not None:
+        # ユーザの投稿に返信するエージェントを、ラウンドの先頭に回す
+        agents.remove(reply_agent)
+        agents.insert(0, reply_agent)
+
+    if batch:
+        run_batched_round(room, agents)
+        return round_interval
+
+    if concurrency > 1:
+        extra = room_scheduler.try_acquire(concurrency - 1)
+        try:
+            committed = run_concurrent_round(room, agents, 1 + extra)
+        finally:
+            room_scheduler.release(extra)
+        # ラウンドの投稿がすべてLLMのエラーなら待ちを延ばす
+        if committed:
+            errors = all(m["text"].startswith("エラー:") for m in committed)
+            room.error_streak = room.error_streak + 1 if errors else 0
+        return round_interval
+
+    if room.agent_cursor >= len(agents):
+        room.agent_cursor = 0
+    # ユーザの投稿があれば、ラウンドの順番より先に返信させる (巡回の位置は進めない)
+    agent = reply_agent
+    if agent is None:
+        agent = agents[room.agent_cursor]
+        room.agent_cursor += 1
+    turn = generate_agent_turn(room, agent)
+    if turn and is_active_agent(room, agent):
+        new_msg = commit_agent_turn(room, turn)
+        room.error_streak = room.error_streak + 1 if new_msg["text"].startswith("エラー:") else 0
+    else:
+        discard_draft(room, turn)
+    if room.agent_cursor >= len(agents):
+        room.agent_cursor = 0
+        return round_interval
+    return agent_interval
 
-threading.Thread(target=conversation_worker, daemon=True).start()
+def pick_reply_agent(room, agents, user_msg):
+    """
+    ユーザの投稿に返信させるエージェント。「@名前」で指名されていればその人、無ければ None (通常の順番)。
+    名前の照合は返信先の取り出しと同じ name_matcher (長い名前を優先) で行う。
+    """
+    if user_msg is None:
+        return None
+    name = room.name_matcher.search(user_msg["text"])
+    return next((agent for agent in agents if agent["name"] == name), None)
+
+def next_step_delay(room, interval, elapsed):
+    """
+    次のステップまでの待ち秒数。
+    - PACING=adaptive: interval を投稿の間隔とみなし、生成にかかった時間を差し引く
+      (バックエンドが遅いときは待ちを足さず、速いときだけ間隔を空ける)。LLMエラーが続くと指数的に待つ
+    - PACING=fixed: 生成後に interval だけ待つ (従来の動作)
+    ユーザの投稿待ちがあれば待たない。
+    """
+    if room.user_pending is not None:
+        return 0
+    scheduler_config = config.get("scheduler", {})
+    if scheduler_config.get("PACING", "adaptive") != "adaptive":
+        return interval
+    if room.error_streak:
+        max_backoff = scheduler_config.get("MAX_BACKOFF", 60)
+        return min(max_backoff, max(interval, 1) * 2 ** (room.error_streak - 1))
+    return max(0.0, interval - elapsed)
+
+class RoomScheduler:
+    """
+    全ルームのエージェント投稿を、LLM_SLOTS 本のスロットで公平に回す中央スケジューラ。
+    - エージェントのいないルームは対象外で、待機中のコストはゼロ (ポーリングしない)
+    - 実行可能なルームのうち閲覧者のいるルームを優先し、同じ優先度なら最後の実行が古い順
+    - 1つのルームで同時に走るステップは1本まで
+    - 要約などステップ以外のLLM呼び出しもスロットを取得してから行う
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.in_use = 0
+        self.active = {}  # room_id -> Room (エージェントのいるルームのみ)
+        self.thread = None
+
+    def slots(self):
+        return max(1, int(config.get("scheduler", {}).get("LLM_SLOTS", 2)))
+
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._dispatch, daemon=True)
+                self.thread.start()
+
+    def wake(self, room):
+        """ルームのエージェント構成が変わったときに呼ぶ"""
+        with self.cond:
+            if room.thread_config["agents"]:
+                self.active[room.room_id] = room
+            else:
+                self.active.pop(room.room_id, None)
+            self.cond.notify_all()
+
+    def wake_all(self):
+        """設定が変わったときに呼ぶ。待機中のルームを見直す (間隔の変更をすぐ反映)"""
+        with self.cond:
+            for room in self.active.values():
+                room.next_turn_at = 0.0
+            self.cond.notify_all()
+
+    def notify_user_post(self, room, msg):
+        """
+        ユーザが投稿したときに呼ぶ。そのルームの待ちを打ち切り、他のルームより優先して
+        次のステップで返信させる (実行中のステップがあれば、その完了直後)。
+        """
+        with self.cond:
+            room.user_pending = msg
+            room.next_turn_at = 0.0
+            self.cond.notify_all()
+
+    def acquire(self):
+        """スロットが空くまで待って1本確保する"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.in_use < self.slots())
+            self.in_use += 1
+
+    def try_acquire(self, n):
+        """待たずに確保できる分だけ (最大n本) 確保し、その本数を返す"""
+        with self.cond:
+            granted = max(0, min(n, self.slots() - self.in_use))
+            self.in_use += granted
+            return granted
+
+    def release(self, n=1):
+        if n <= 0:
+            return
+        with self.cond:
+            self.in_use -= n
+            self.cond.notify_all()
+
+    def _pick(self, now):
+        """実行するルームと、次に見直すまでの秒数を返す"""
+        best, best_key, wait = None, None, None
+        for room in self.active.values():
+            if room.running:
+                continue
+            if room.next_turn_at > now:
+                delay = room.next_turn_at - now
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            key = (0 if room.user_pending is not None else 1, 0 if room.has_viewers() else 1, room.last_run_at)
+            if best_key is None or key < best_key:
+                best, best_key = room, key
+        return best, wait
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                if state_backend and not state_backend.is_leader:
+                    # 共有バックエンドではリーダーのプロセスだけがエージェントを動かす
+                    self.cond.wait(state_backend.poll_interval)
+                    continue
+                room, wait = self._pick(time.time())
+                if room is None or self.in_use >= self.slots():
+                    self.cond.wait(wait if room is None else None)
+                    continue
+                room.running = True
+                room.last_run_at = time.time()
+                self.in_use += 1
+            # ステップはデーモンスレッドで実行 (LLM応答待ちでもプロセス終了を妨げない)
+            threading.Thread(target=self._run_step, args=(room,), daemon=True).start()
+
+    def _run_step(self, room):
+        delay = config.get("scheduler", {}).get("ROUND_INTERVAL", 5)
+        elapsed = 0.0
+        try:
+            with metrics.timer("autochat_room_step_seconds") as timer:
+                delay = run_room_step(room)
+            elapsed = timer.elapsed
+        except Exception as e:
+            print(f"ルーム {room.room_id} のエージェント投稿エラー: {e}")
+        with self.cond:
+            room.running = False
+            room.next_turn_at = time.time() + next_step_delay(room, delay, elapsed)
+            self.in_use -= 1
+            if not room.thread_config["agents"]:
+                self.active.pop(room.room_id, None)
+            self.cond.notify_all()
+
+room_scheduler = RoomScheduler()
+
+def run_with_llm_slot(func, *args):
+    """LLMスロットを1本確保してから func を実行する (要約ジョブなど)"""
+    room_scheduler.acquire()
+    try:
+        return func(*args)
+    finally:
+        room_scheduler.release()
+
+room_scheduler.start()
+if state_backend:
+    state_backend.start()
 
 ###############################################################################
 # 8. テンプレート (ベース)
@@ -359,6 +3355,10 @@ BASE_HTML = '''
     .conversation-container {
       margin-bottom: 20px;
     }
+    .post-draft {
+      color: #6c757d;
+      font-style: italic;
+    }
     .agent-list-item {
       margin-bottom: 5px;
     }
@@ -368,9 +3368,11 @@ BASE_HTML = '''
 <div class="container mt-3">
   <h1 class="text-center mb-4">エージェント会話システム</h1>
   <div class="mb-3 text-right">
-    <a href="{{ url_for('index') }}" class="btn btn-secondary">会話画面</a>
+    <a href="{{ url_for('rooms_page') }}" class="btn btn-light">ルーム一覧</a>
+    <a href="{{ url_for('index', room_id=room_id) }}" class="btn btn-secondary">会話画面</a>
     <a href="{{ url_for('config_page') }}" class="btn btn-info">基本設定</a>
-    <a href="{{ url_for('summary_page') }}" class="btn btn-warning">まとめページ</a>
+    <a href="{{ url_for('summary_page', room_id=room_id) }}" class="btn btn-warning">まとめページ</a>
+    <a href="{{ url_for('history_page', room_id=room_id) }}" class="btn btn-outline-dark">過去ログ検索</a>
   </div>
   {% with messages = get_flashed_messages() %}
     {% if messages %}
@@ -387,18 +3389,8 @@ BASE_HTML = '''
 </html>
 '''
 
-###############################################################################
-# 9. メイン画面 (会話表示 + ユーザ投稿 + エージェント管理)
-###############################################################################
-
-@app.route('/', methods=['GET'])
-def index():
-    max_display = config["conversation"].get("MAX_DISPLAY_MESSAGES", 50)
-    display_conversation = conversation[-max_display:]
-
-    # 初期描画用HTML
-    conversation_html = render_template_string('''
-    {% for msg in msgs|reverse %}
+# 投稿1件。メイン画面・差分更新・SSE配信で共用
+POST_HTML = '''
       <div class="post">
         <span class="post-number">{{ msg.number }}.</span>
         <span class="post-agent">{{ msg.agent }}</span>
@@ -406,16 +3398,68 @@ def index():
           <span class="post-reply">>>{{ msg.reply_to }}</span>
         {% endif %}
         : {{ msg.text }}
-      </div>
-    {% endfor %}
-    ''', msgs=display_conversation)
+      </div>'''
 
-    body = render_template_string('''
+# よく使うテンプレートは起動時に1回だけコンパイルしておく
+BASE_TEMPLATE = app.jinja_env.from_string(BASE_HTML)
+POST_TEMPLATE = app.jinja_env.from_string(POST_HTML)
+
+def post_html(msg):
+    """
+    投稿1件のHTML断片。メモリ上の会話の投稿は描画結果をレコードに持たせて使い回すため、
+    描画は投稿ごとに1回だけで、会話の長さ制限で押し出されると一緒に捨てられる。
+    """
+    html = getattr(msg, "html", None)
+    if html is None:
+        html = POST_TEMPLATE.render(msg=msg)
+        if isinstance(msg, Message):
+            msg.html = html
+    return html
+
+def render_posts(msgs):
+    """投稿一覧 (新しい順) のHTML。描画済みの断片をつなぐだけ"""
+    return "".join(post_html(msg) for msg in reversed(msgs))
+
+###############################################################################
+# 9. メイン画面 (会話表示 + ユーザ投稿 + エージェント管理)
+###############################################################################
+
+def room_route(rule, **options):
+    """
+    同じビュー関数を、既定ルーム用の rule と /room/<room_id> 配下の rule の両方に登録する。
+    ビュー関数は room_id 引数を受け取る。
+    """
+    def decorator(f):
+        app.add_url_rule(rule, view_func=f, defaults={"room_id": DEFAULT_ROOM_ID}, **options)
+        app.add_url_rule("/room/<room_id>" + rule, view_func=f, **options)
+        return f
+    return decorator
+
+def get_room(room_id):
+    """ルームを返す。存在しなければ404"""
+    room = rooms.get(room_id)
+    if room is None:
+        abort(404)
+    return room
+
+GZIP_MIN_BYTES = 1024
+
+def compressible_response(html, headers=None):
+    """クライアントが gzip を受け付け、ある程度の大きさがあれば圧縮して返す"""
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    body = html.encode("utf-8")
+    if len(body) >= GZIP_MIN_BYTES and request.accept_encodings["gzip"]:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, 200, headers, mimetype="text/html")
+
+INDEX_HTML = '''
       <div class="row">
         <!-- 左カラム: スレッド情報・会話 -->
         <div class="col-md-8">
           <h4>スレッドタイトル: {{ thread_config["title"] }}</h4>
-          <form method="post" action="/set_thread_title" class="form-inline mb-3">
+          <form method="post" action="{{ url_for('set_thread_title', room_id=room_id) }}" class="form-inline mb-3">
             <label class="mr-2">スレタイ入力:</label>
             <input type="text" name="thread_title" class="form-control mr-2" placeholder="スレッドタイトル">
             <button type="submit" class="btn btn-primary">設定</button>
@@ -423,18 +3467,22 @@ def index():
 
           <h4>会話スレッド (自動更新)</h4>
           <div class="conversation-container">
-            <div class="conversation" id="conversation-container">
+            <div class="conversation" id="conversation-container"
+                 data-last-number="{{ last_number }}" data-epoch="{{ epoch }}" data-max-display="{{ max_display }}"
+                 data-event-id="{{ event_id }}"
+                 data-partial-url="{{ url_for('conversation_partial', room_id=room_id) }}"
+                 data-stream-url="{{ url_for('stream', room_id=room_id) }}">
               {{ conversation_html|safe }}
             </div>
           </div>
 
-          <form method="post" action="/clear_conversation" class="d-inline mb-3">
+          <form method="post" action="{{ url_for('clear_conversation', room_id=room_id) }}" class="d-inline mb-3">
             <button type="submit" class="btn btn-warning">会話履歴をクリア</button>
           </form>
-          <a href="/" class="btn btn-secondary mb-3">更新</a>
+          <a href="{{ url_for('index', room_id=room_id) }}" class="btn btn-secondary mb-3">更新</a>
 
           <h5>あなたも参加</h5>
-          <form method="post" action="/post_user_message" class="form-inline mb-3">
+          <form method="post" action="{{ url_for('post_user_message', room_id=room_id) }}" class="form-inline mb-3">
             <input type="text" name="username" class="form-control mr-2" placeholder="お名前" required>
             <input type="text" name="message" class="form-control mr-2" placeholder="メッセージ" required>
             <button type="submit" class="btn btn-success">送信</button>
@@ -444,7 +3492,7 @@ def index():
         <!-- 右カラム: エージェント管理 & スレッド設定エクスポート/インポート -->
         <div class="col-md-4">
           <h4>エージェント管理</h4>
-          <form method="post" action="/add_agent" class="mb-3">
+          <form method="post" action="{{ url_for('add_agent', room_id=room_id) }}" class="mb-3">
             <div class="form-group">
               <label>名前:</label>
               <input type="text" name="name" class="form-control" required>
@@ -453,14 +3501,18 @@ def index():
               <label>性格:</label>
               <input type="text" name="personality" class="form-control" required>
             </div>
+            <div class="form-group">
+              <label>モデル (任意):</label>
+              <input type="text" name="model" class="form-control" placeholder="空欄なら既定のモデル">
+            </div>
             <button type="submit" class="btn btn-primary btn-block">エージェント追加</button>
           </form>
           <h5>登録済みエージェント</h5>
           <ul class="list-group mb-4">
             {% for agent in thread_config["agents"] %}
               <li class="list-group-item d-flex justify-content-between align-items-center agent-list-item">
-                <span>{{ agent.name }} ({{ agent.personality }})</span>
-                <form method="post" action="/delete_agent/{{ agent.id }}" onsubmit="return confirm('このエージェントを削除してもよろしいですか？');">
+                <span>{{ agent.name }} ({{ agent.personality }}){% if agent.model %} <small class="text-muted">[{{ agent.model }}]</small>{% endif %}</span>
+                <form method="post" action="{{ url_for('delete_agent', room_id=room_id, agent_id=agent.id) }}" onsubmit="return confirm('このエージェントを削除してもよろしいですか？');">
                   <button type="submit" class="btn btn-danger btn-sm">削除</button>
                 </form>
               </li>
@@ -474,19 +3526,31 @@ def index():
           <div class="mb-3">
             <button type="button" class="btn btn-info" onclick="exportThreadConfig()">エクスポート</button>
           </div>
-          <form method="post" action="/import_thread_config">
+          <form method="post" action="{{ url_for('import_thread_config', room_id=room_id) }}">
             <div class="form-group">
               <textarea name="thread_config_json" id="threadConfigJson" class="form-control" rows="5"></textarea>
             </div>
             <button type="submit" class="btn btn-primary">インポート</button>
           </form>
+
+          <h4 class="mt-4">会話履歴のエクスポート/インポート</h4>
+          <p class="small">スレッド設定と全履歴をNDJSONファイルで移行できます。インポートした投稿は現在の会話の後ろに番号を振り直して追加されます。</p>
+          <div class="mb-3">
+            <a href="{{ url_for('export_conversation', room_id=room_id) }}" class="btn btn-info">エクスポート</a>
+          </div>
+          <form method="post" action="{{ url_for('import_conversation', room_id=room_id) }}" enctype="multipart/form-data">
+            <div class="form-group">
+              <input type="file" name="conversation_file" class="form-control-file" accept=".ndjson,.jsonl" required>
+            </div>
+            <button type="submit" class="btn btn-primary">インポート</button>
+          </form>
         </div>
       </div>
 
       <!-- スレッド設定をAjaxで取得して表示する -->
       <script>
       function exportThreadConfig() {
-        fetch('/export_thread_config')
+        fetch('{{ url_for('export_thread_config', room_id=room_id) }}')
           .then(response => response.json())
           .then(data => {
             document.getElementById('threadConfigJson').value = JSON.stringify(data, null, 2);
@@ -494,117 +3558,284 @@ def index():
           .catch(err => alert('エクスポート失敗: ' + err));
       }
 
-      // 2秒おきに会話部分を更新
+      // 新着投稿はSSEで受け取り先頭に追加。EventSource非対応なら2秒おきの差分取得
+      const container = document.getElementById('conversation-container');
+      let lastNumber = parseInt(container.dataset.lastNumber, 10);
+      let epoch = container.dataset.epoch;
+      let etag = null;
+      const maxDisplay = parseInt(container.dataset.maxDisplay, 10);
+
+      function prependPosts(html) {
+        container.insertAdjacentHTML('afterbegin', html);
+        const posts = container.querySelectorAll('.post:not(.post-draft)');
+        for (let i = maxDisplay; i < posts.length; i++) {
+          posts[i].remove();
+        }
+      }
+
+      function removeDraft(draftId) {
+        const draft = container.querySelector('[data-draft="' + draftId + '"]');
+        if (draft) {
+          draft.remove();
+        }
+      }
+
       function updateConversation() {
-        fetch('/conversation_partial')
-          .then(response => response.text())
-          .then(html => {
-            document.getElementById('conversation-container').innerHTML = html;
+        const headers = etag ? {'If-None-Match': etag} : {};
+        fetch(container.dataset.partialUrl + '?since=' + lastNumber + '&epoch=' + epoch, {headers: headers})
+          .then(response => {
+            if (response.status === 304) {
+              return;
+            }
+            etag = response.headers.get('ETag');
+            lastNumber = parseInt(response.headers.get('X-Last-Number'), 10);
+            epoch = response.headers.get('X-Epoch');
+            const mode = response.headers.get('X-Mode');
+            return response.text().then(html => {
+              if (mode === 'full') {
+                container.innerHTML = html;
+              } else {
+                prependPosts(html);
+              }
+            });
           })
           .catch(err => console.log("Error fetching conversation partial:", err));
       }
-      setInterval(updateConversation, 2000);
+
+      if (window.EventSource) {
+        const source = new EventSource(container.dataset.streamUrl + '?last_event_id=' + container.dataset.eventId);
+        source.addEventListener('post', e => {
+          const data = JSON.parse(e.data);
+          if (data.draft) {
+            removeDraft(data.draft);
+          }
+          if (String(data.epoch) !== String(epoch)) {
+            updateConversation();
+          } else if (data.number > lastNumber) {
+            prependPosts(data.html);
+            lastNumber = data.number;
+          }
+        });
+        source.addEventListener('reset', () => updateConversation());
+        // 生成途中の投稿 (下書き) を表示・更新
+        source.addEventListener('draft', e => {
+          const data = JSON.parse(e.data);
+          if (String(data.epoch) !== String(epoch)) {
+            return;
+          }
+          let draft = container.querySelector('[data-draft="' + data.draft + '"]');
+          if (!draft) {
+            draft = document.createElement('div');
+            draft.className = 'post post-draft';
+            draft.dataset.draft = data.draft;
+            draft.innerHTML = '<span class="post-agent"></span> : <span class="post-text"></span>';
+            draft.querySelector('.post-agent').textContent = data.agent;
+            container.prepend(draft);
+          }
+          draft.querySelector('.post-text').textContent = data.text;
+        });
+        source.addEventListener('draft_end', e => removeDraft(JSON.parse(e.data).draft));
+        // 再接続時は取りこぼし分を差分取得で補う
+        source.addEventListener('open', () => updateConversation());
+      } else {
+        setInterval(updateConversation, 2000);
+      }
       </script>
-    ''', conversation_html=conversation_html, thread_config=thread_config)
+'''
+INDEX_TEMPLATE = app.jinja_env.from_string(INDEX_HTML)
 
-    return render_template_string(BASE_HTML, body=body)
+@room_route('/', methods=['GET'])
+def index(room_id):
+    room = get_room(room_id)
+    room.last_viewed = time.time()
+    max_display = config["conversation"].get("MAX_DISPLAY_MESSAGES", 50)
+    display_conversation = room.conversation.tail(max_display)
+
+    # 初期描画用HTML
+    with metrics.timer("autochat_render_seconds", view="index"):
+        conversation_html = render_posts(display_conversation)
+
+    body = render_template(
+        INDEX_TEMPLATE, conversation_html=conversation_html, thread_config=room.thread_config, room_id=room.room_id,
+        last_number=room.post_counter - 1, epoch=room.conversation_epoch, max_display=max_display,
+        event_id=room.broadcaster.last_id
+    )
+
+    return compressible_response(render_template(BASE_TEMPLATE, body=body, room_id=room.room_id))
 
 ###############################################################################
-# 10. 会話部分のみ返すエンドポイント (Ajax用)
+# 10. 会話部分のみ返すエンドポイント (Ajax用) / SSE配信
 ###############################################################################
 
-@app.route('/conversation_partial', methods=['GET'])
-def conversation_partial():
+@room_route('/conversation_partial', methods=['GET'])
+def conversation_partial(room_id):
+    """
+    会話部分のHTMLを返す。
+    - since=<投稿番号>&epoch=<世代> を付けるとそれより新しい投稿だけを返す (X-Mode: delta)
+    - ETag は (世代, post_counter) で決まり、If-None-Match が一致すれば 304
+    - クリア後や表示件数を超えて遅れている場合は全体を返す (X-Mode: full)
+    """
+    room = get_room(room_id)
+    room.last_viewed = time.time()
+    etag = f'"{room.conversation_epoch}-{room.post_counter}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "X-Last-Number": str(room.post_counter - 1),
+        "X-Epoch": str(room.conversation_epoch),
+        "Vary": "Accept-Encoding"
+    }
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304, headers
+
     max_display = config["conversation"].get("MAX_DISPLAY_MESSAGES", 50)
-    display_conversation = conversation[-max_display:]
-    partial_html = render_template_string('''
-    {% for msg in msgs|reverse %}
-      <div class="post">
-        <span class="post-number">{{ msg.number }}.</span>
-        <span class="post-agent">{{ msg.agent }}</span>
-        {% if msg.reply_to %}
-          <span class="post-reply">>>{{ msg.reply_to }}</span>
-        {% endif %}
-        : {{ msg.text }}
-      </div>
-    {% endfor %}
-    ''', msgs=display_conversation)
-    return partial_html
+    since = request.args.get("since", type=int)
+    epoch = request.args.get("epoch", type=int)
+    display_conversation = None
+    if since is not None and epoch == room.conversation_epoch and since < room.post_counter:
+        new_messages = messages_since(room, since)
+        if len(new_messages) < max_display:
+            display_conversation = new_messages
+            headers["X-Mode"] = "delta"
+    if display_conversation is None:
+        display_conversation = room.conversation.tail(max_display)
+        headers["X-Mode"] = "full"
+    with metrics.timer("autochat_render_seconds", view="conversation_partial"):
+        partial_html = render_posts(display_conversation)
+    return compressible_response(partial_html, headers)
+
+@room_route('/stream', methods=['GET'])
+def stream(room_id):
+    """新着投稿を Server-Sent Events で配信 (Last-Event-ID で取りこぼし分から再開)"""
+    room = get_room(room_id)
+    last_id = request.headers.get("Last-Event-ID", type=int)
+    if last_id is None:
+        last_id = request.args.get("last_event_id", type=int)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(room.broadcaster.subscribe(last_id), mimetype="text/event-stream", headers=headers)
+
+MAX_POSTS_RANGE = 500
+
+@room_route('/posts/<int:first>', methods=['GET'])
+@room_route('/posts/<int:first>-<int:last>', methods=['GET'])
+def read_posts(room_id, first, last=None):
+    """
+    現在の会話の first〜last 番の投稿をJSONで返す。
+    メモリ上の直近分より古い投稿も、会話ストアの索引からシークして読み出す。
+    まだログに書かれていない直近の投稿はメモリ上の会話から補う。
+    """
+    room = get_room(room_id)
+    last = first if last is None else last
+    if last < first or last - first >= MAX_POSTS_RANGE:
+        abort(400)
+    try:
+        messages = log_reader(room).read_range(first, last)
+    except (OSError, ValueError) as e:
+        print(f"会話ログの読み出しエラー: {e}")
+        messages = merge_memory_posts(room, [], first, last)
+        if not messages:
+            abort(503)
+    else:
+        messages = merge_memory_posts(room, messages, first, last)
+    return jsonify({"epoch": room.conversation_epoch, "messages": [dict(m) for m in messages]})
 
 ###############################################################################
 # 11. 投稿・エージェント管理
 ###############################################################################
 
-@app.route('/post_user_message', methods=['POST'])
-def post_user_message():
-    global post_counter
+@room_route('/post_user_message', methods=['POST'])
+def post_user_message(room_id):
+    room = get_room(room_id)
     username = request.form.get("username", "").strip()
     message = request.form.get("message", "").strip()
     if username and message:
-        new_msg = {
-            "number": post_counter,
-            "agent": username,
-            "reply_to": None,
-            "text": message,
-            "timestamp": time.time()
-        }
-        conversation.append(new_msg)
-        post_counter += 1
-        log_message_to_file(new_msg)
-        save_conversation()
-        on_new_message_posted()
-
-        max_len = config["conversation"].get("MAX_CONVERSATION_LENGTH", 100)
-        if len(conversation) > max_len:
-            conversation[:] = conversation[-max_len:]
-            save_conversation()
-    return redirect(url_for('index'))
-
-@app.route('/clear_conversation', methods=['POST'])
-def clear_conversation():
-    global conversation, post_counter
-    conversation = []
-    post_counter = 1
-    save_conversation()
-    return redirect(url_for('index'))
-
-@app.route('/add_agent', methods=['POST'])
-def add_agent():
-    global next_agent_id
+        append_message(room, username, message)
+    return redirect(url_for('index', room_id=room_id))
+
+@room_route('/clear_conversation', methods=['POST'])
+def clear_conversation(room_id):
+    room = get_room(room_id)
+    clear_messages(room)
+    return redirect(url_for('index', room_id=room_id))
+
+@room_route('/add_agent', methods=['POST'])
+def add_agent(room_id):
+    room = get_room(room_id)
     name = request.form.get("name", "").strip()
     personality = request.form.get("personality", "").strip()
+    model = request.form.get("model", "").strip()
     if name and personality:
-        agent = {"id": next_agent_id, "name": name, "personality": personality}
-        next_agent_id += 1
-        thread_config["agents"].append(agent)
-    return redirect(url_for('index'))
-
-@app.route('/delete_agent/<int:agent_id>', methods=['POST'])
-def delete_agent(agent_id):
-    agents = thread_config["agents"]
-    thread_config["agents"] = [a for a in agents if a["id"] != agent_id]
-    return redirect(url_for('index'))
-
-@app.route('/set_thread_title', methods=['POST'])
-def set_thread_title():
+        def add(room):
+            agent = {"id": room.next_agent_id, "name": name, "personality": personality}
+            if model:
+                agent["model"] = model
+            room.next_agent_id += 1
+            room.thread_config["agents"].append(agent)
+        update_thread_config(room, add)
+    return redirect(url_for('index', room_id=room_id))
+
+@room_route('/delete_agent/<int:agent_id>', methods=['POST'])
+def delete_agent(room_id, agent_id):
+    room = get_room(room_id)
+
+    def delete(room):
+        agents = room.thread_config["agents"]
+        room.thread_config["agents"] = [a for a in agents if a["id"] != agent_id]
+    update_thread_config(room, delete)
+    room.prompt_prefix_cache.pop(agent_id, None)
+    return redirect(url_for('index', room_id=room_id))
+
+@room_route('/set_thread_title', methods=['POST'])
+def set_thread_title(room_id):
+    room = get_room(room_id)
     title = request.form.get("thread_title", "").strip()
-    thread_config["title"] = title if title else "未設定"
-    return redirect(url_for('index'))
-
-@app.route('/export_thread_config', methods=['GET'])
-def export_thread_config():
-    return jsonify(thread_config)
-
-@app.route('/import_thread_config', methods=['POST'])
-def import_thread_config():
-    global next_agent_id
+    update_thread_config(room, lambda room: room.thread_config.update(title=title if title else "未設定"))
+    return redirect(url_for('index', room_id=room_id))
+
+@room_route('/export_thread_config', methods=['GET'])
+def export_thread_config(room_id):
+    room = get_room(room_id)
+    return jsonify(room.thread_config)
+
+@room_route('/export_conversation', methods=['GET'])
+def export_conversation(room_id):
+    """スレッド設定と全履歴をNDJSONでストリーミング出力する"""
+    room = get_room(room_id)
+    headers = {"Content-Disposition": f'attachment; filename="{room.room_id}-conversation.ndjson"'}
+    return Response(export_conversation_ndjson(room), mimetype="application/x-ndjson", headers=headers)
+
+@room_route('/import_conversation', methods=['POST'])
+def import_conversation(room_id):
+    """
+    NDJSONの会話を取り込む。フォームのファイル (conversation_file) か、
+    リクエスト本文そのもの (Content-Type: application/x-ndjson) を1行ずつ読む。
+    """
+    room = get_room(room_id)
+    upload = request.files.get("conversation_file")
+    stream = upload.stream if upload else request.stream
+    try:
+        count = import_conversation_ndjson(room, stream)
+        message = f"{count}件の投稿をインポートしました。"
+    except Exception as e:
+        if upload is None:
+            return jsonify({"error": str(e)}), 400
+        flash(f"インポート失敗: {e}")
+        return redirect(url_for('index', room_id=room_id))
+    if upload is None:
+        return jsonify({"imported": count, "post_counter": room.post_counter})
+    flash(message)
+    return redirect(url_for('index', room_id=room_id))
+
+@room_route('/import_thread_config', methods=['POST'])
+def import_thread_config(room_id):
+    room = get_room(room_id)
     json_str = request.form.get("thread_config_json", "")
     try:
-        import_thread_config_json(json_str)
+        import_thread_config_json(room, json_str)
         flash("スレッド設定をインポートしました。")
     except Exception as e:
         flash(f"インポート失敗: {e}")
-    return redirect(url_for('index'))
+    return redirect(url_for('index', room_id=room_id))
 
 ###############################################################################
 # 12. 基本設定ページ (config.json)
@@ -612,14 +3843,15 @@ def import_thread_config():
 
 @app.route('/config', methods=['GET', 'POST'])
 def config_page():
-    global config, chat_instance
+    global config, config_version
     if request.method == "POST":
         config_text = request.form.get("config_text", "")
         try:
             new_config = json.loads(config_text)
             config = new_config
             save_config()
-            chat_instance = Chat()
+            config_version += 1
+            room_scheduler.wake_all()
             flash("基本設定を更新しました。")
         except Exception as e:
             flash(f"設定更新エラー: {e}")
@@ -636,36 +3868,223 @@ def config_page():
           </form>
           <a href="{{ url_for('index') }}" class="btn btn-secondary mt-3">会話画面へ戻る</a>
         ''', config_json=json.dumps(config, ensure_ascii=False, indent=2))
-        return render_template_string(BASE_HTML, body=body)
+        return render_template(BASE_TEMPLATE, body=body, room_id=DEFAULT_ROOM_ID)
 
 ###############################################################################
 # 13. まとめページ
 ###############################################################################
 
-@app.route('/summary', methods=['GET'])
-def summary_page():
+@room_route('/summary', methods=['GET'])
+def summary_page(room_id):
+    room = get_room(room_id)
     body = render_template_string('''
       <h2>議論まとめ</h2>
       <p>現在の会話を要約したものを表示しています。一定数の投稿があると自動更新されますが、手動更新も可能です。</p>
       <div class="card mb-3">
         <div class="card-body" style="white-space: pre-wrap;">{{ thread_config["summary"] if thread_config["summary"] else "まだまとめはありません。" }}</div>
       </div>
-      <form method="post" action="/generate_summary">
-        <button type="submit" class="btn btn-warning">まとめを更新</button>
+      <form method="post" action="{{ url_for('generate_summary_route', room_id=room_id) }}">
+        <button type="submit" name="wait" value="1" class="btn btn-warning">まとめを更新</button>
+        <button type="submit" name="wait" value="0" class="btn btn-outline-warning">バックグラウンドで更新</button>
       </form>
-      <a href="{{ url_for('index') }}" class="btn btn-secondary mt-3">会話画面へ戻る</a>
-    ''', thread_config=thread_config)
-    return render_template_string(BASE_HTML, body=body)
+      <a href="{{ url_for('index', room_id=room_id) }}" class="btn btn-secondary mt-3">会話画面へ戻る</a>
+    ''', thread_config=room.thread_config, room_id=room.room_id)
+    return render_template(BASE_TEMPLATE, body=body, room_id=room.room_id)
+
+@room_route('/generate_summary', methods=['POST'])
+def generate_summary_route(room_id):
+    """要約ジョブを依頼する。wait=1 なら完了まで (最大 timeout 秒) 待つ"""
+    room = get_room(room_id)
+    ticket = room.summary_job.request()
+    if request.form.get("wait", "1") == "1":
+        timeout = request.form.get("timeout", 120, type=float)
+        if room.summary_job.wait(ticket, timeout):
+            flash("まとめを更新しました。")
+        else:
+            flash("まとめを更新中です。しばらくしてから再読み込みしてください。")
+    else:
+        flash("まとめの更新を開始しました。")
+    return redirect(url_for('summary_page', room_id=room_id))
+
+###############################################################################
+# 14. 過去ログ検索
+###############################################################################
+
+HISTORY_PAGE_SIZE = 50
+
+def parse_time_param(value):
+    """"2024-01-31" / "2024-01-31T12:00" (ローカル時刻) または UNIX秒を受け取り、UNIX秒で返す"""
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.template_filter('localtime')
+def localtime_filter(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+@room_route('/history', methods=['GET'])
+def history_page(room_id):
+    """
+    全投稿の検索・ページング。q (本文, 空白区切りでAND)・agent・reply_to・since/until・before (ページ位置) で絞り込む。
+    format=json ならJSONで返す。
+    """
+    room = get_room(room_id)
+    if history_index is None:
+        abort(404)
+    query = request.args.get("q", "").strip()
+    agent = request.args.get("agent", "").strip()
+    reply_to = request.args.get("reply_to", "").strip()
+    before = request.args.get("before", type=int)
+    try:
+        since = parse_time_param(request.args.get("since"))
+        until = parse_time_param(request.args.get("until"))
+    except ValueError:
+        abort(400)
+    limit = max(1, min(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 500))
+    results, next_before = history_index.search(
+        room.room_id, query, agent, reply_to, since, until, before, limit
+    )
+    if request.args.get("format") == "json":
+        return jsonify({"messages": results, "next_before": next_before})
+
+    next_url = None
+    if next_before is not None:
+        args = request.args.to_dict()
+        args["before"] = next_before
+        next_url = url_for('history_page', room_id=room_id, **args)
+    body = render_template_string('''
+      <h2>過去ログ検索</h2>
+      <form method="get" class="mb-3">
+        <div class="form-row">
+          <div class="col-md-4 mb-2"><input type="text" name="q" class="form-control" placeholder="本文 (空白区切りでAND)" value="{{ query }}"></div>
+          <div class="col-md-2 mb-2"><input type="text" name="agent" class="form-control" placeholder="発言者" value="{{ agent }}"></div>
+          <div class="col-md-2 mb-2"><input type="text" name="reply_to" class="form-control" placeholder="返信先 (名前)" value="{{ reply_to }}"></div>
+          <div class="col-md-2 mb-2"><input type="datetime-local" name="since" class="form-control" value="{{ request.args.get('since', '') }}"></div>
+          <div class="col-md-2 mb-2"><input type="datetime-local" name="until" class="form-control" value="{{ request.args.get('until', '') }}"></div>
+        </div>
+        <button type="submit" class="btn btn-primary">検索</button>
+      </form>
+      <div class="conversation mb-3">
+        {% for msg in results %}
+          <div class="post">
+            <span class="post-number">{{ msg.number }}.</span>
+            <span class="post-agent">{{ msg.agent }}</span>
+            {% if msg.reply_to %}
+              <span class="post-reply">>>{{ msg.reply_to }}</span>
+            {% endif %}
+            : {{ msg.text }}
+            <span class="small text-muted ml-2">{{ msg.timestamp|int|localtime }}</span>
+          </div>
+        {% else %}
+          <p>該当する投稿はありません。</p>
+        {% endfor %}
+      </div>
+      {% if next_url %}
+        <a href="{{ next_url }}" class="btn btn-outline-secondary">さらに古い投稿</a>
+      {% endif %}
+      <form method="post" action="{{ url_for('rebuild_history_index_route', room_id=room_id) }}" class="mt-3">
+        <button type="submit" class="btn btn-sm btn-outline-danger">検索インデックスを作り直す</button>
+      </form>
+    ''', room_id=room.room_id, results=results, query=query, agent=agent, reply_to=reply_to, next_url=next_url)
+    return render_template(BASE_TEMPLATE, body=body, room_id=room.room_id)
+
+@room_route('/rebuild_history_index', methods=['POST'])
+def rebuild_history_index_route(room_id):
+    """検索インデックスを会話ストアの全履歴から作り直す"""
+    room = get_room(room_id)
+    if history_index is None:
+        abort(404)
+    rebuild_history_index(room)
+    flash("検索インデックスを作り直しました。")
+    return redirect(url_for('history_page', room_id=room_id))
+
+###############################################################################
+# 15. ルーム一覧
+###############################################################################
+
+@app.route('/rooms', methods=['GET'])
+def rooms_page():
+    room_list = sorted(rooms.values(), key=lambda r: r.room_id)
+    body = render_template_string('''
+      <h2>ルーム一覧</h2>
+      <p>ルームごとに独立したエージェント・まとめ・会話ログを持ちます。</p>
+      <ul class="list-group mb-4">
+        {% for room in room_list %}
+          <li class="list-group-item d-flex justify-content-between align-items-center">
+            <a href="{{ url_for('index', room_id=room.room_id) }}">{{ room.room_id }}: {{ room.thread_config["title"] }}</a>
+            <span class="small">
+              投稿 {{ room.post_counter - 1 }} / エージェント {{ room.thread_config["agents"]|length }}
+              {% if room.has_viewers() %}/ 閲覧中{% endif %}
+            </span>
+          </li>
+        {% endfor %}
+      </ul>
+      <h4>ルームを作成</h4>
+      <form method="post" action="{{ url_for('create_room_route') }}" class="form-inline">
+        <input type="text" name="room_id" class="form-control mr-2" placeholder="ルームID (英数字・_-)" required>
+        <input type="text" name="title" class="form-control mr-2" placeholder="スレッドタイトル">
+        <button type="submit" class="btn btn-primary">作成</button>
+      </form>
+    ''', room_list=room_list)
+    return render_template(BASE_TEMPLATE, body=body, room_id=DEFAULT_ROOM_ID)
+
+@app.route('/create_room', methods=['POST'])
+def create_room_route():
+    room_id = request.form.get("room_id", "").strip()
+    title = request.form.get("title", "").strip()
+    if not ROOM_ID_PATTERN.match(room_id):
+        flash("ルームIDは英数字・_・- の32文字以内で指定してください。")
+        return redirect(url_for('rooms_page'))
+    room = create_room(room_id)
+    if title:
+        update_thread_config(room, lambda room: room.thread_config.update(title=title))
+    return redirect(url_for('index', room_id=room_id))
+
+###############################################################################
+# 16. メトリクス (/metrics)
+###############################################################################
 
-@app.route('/generate_summary', methods=['POST'])
-def generate_summary_route():
-    generate_summary()
-    flash("まとめを更新しました。")
-    return redirect(url_for('summary_page'))
+metrics.gauge("autochat_llm_cache_entries", "LLM応答キャッシュの件数",
+              lambda: [({}, response_cache.stats()["entries"])])
+metrics.gauge("autochat_llm_cache_requests_total", "LLM応答キャッシュの参照数 (result=hit/miss)",
+              lambda: [({"result": "hit"}, response_cache.hits), ({"result": "miss"}, response_cache.misses)],
+              kind="counter")
+metrics.gauge("autochat_llm_slots_in_use", "使用中のLLMスロット数", lambda: [({}, room_scheduler.in_use)])
+metrics.gauge("autochat_llm_backend_outstanding", "LLMサーバーごとの実行中のリクエスト数",
+              lambda: [({"backend": b["name"]}, b["outstanding"]) for b in get_chat().pool.status()])
+metrics.gauge("autochat_llm_backend_healthy", "LLMサーバーが振り分け対象なら1、切り離し中なら0",
+              lambda: [({"backend": b["name"]}, int(b["healthy"])) for b in get_chat().pool.status()])
+metrics.gauge("autochat_room_posts", "ルームのメモリ上の投稿数",
+              lambda: [({"room": r.room_id}, len(r.conversation)) for r in list(rooms.values())])
+metrics.gauge("autochat_room_subscribers", "ルームのSSE購読者数",
+              lambda: [({"room": r.room_id}, r.broadcaster.subscribers) for r in list(rooms.values())])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    """リクエストの処理時間を記録。config["metrics"]["REQUEST_LOG"] が true なら1行ずつ出力する"""
+    started = getattr(g, "request_started", None)
+    if started is not None and request.endpoint != "stream":
+        elapsed = time.perf_counter() - started
+        metrics.observe("autochat_http_request_seconds", elapsed, endpoint=request.endpoint or "unknown")
+        if config.get("metrics", {}).get("REQUEST_LOG", False):
+            print(f"{request.method} {request.full_path.rstrip('?')} {response.status_code} {elapsed * 1000:.1f}ms")
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 ###############################################################################
-# 14. アプリ起動
+# 17. アプリ起動
 ###############################################################################
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5678, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5678, debug=True)
@@ -0,0 +1,246 @@
+"""
+AutoChat のベンチマーク。
+
+モックLLMサーバー (bench/mock_openai_server.py) を起動して config["chat"]["base_url"] をそこへ向け、
+一時ディレクトリ上でアプリを動かして次を計測します。結果はJSONで出力します。
+
+- agents      : エージェント投稿のスループット (投稿/分)
+- summary     : まとめ生成の所要時間 (初回 / 1件追加後の再計算)
+- polling     : N 並列のポーリングに対する /conversation_partial のリクエスト/秒と応答時間
+- persistence : 履歴が増えるにつれての投稿1件あたりの保存コストとディスク使用量
+
+    python bench/benchmark.py --agents 4 --pollers 16 --output result.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_openai_server import MockSettings, start_server  # noqa: E402
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def set_agents(app, room, count):
+    def apply(room):
+        room.thread_config["agents"] = [
+            {"id": i + 1, "name": f"agent{i + 1}", "personality": "冷静で簡潔に話す"} for i in range(count)
+        ]
+        room.next_agent_id = count + 1
+    app.update_thread_config(room, apply)
+
+def bench_agents(app, agents, duration):
+    """エージェントを動かし続けて、一定時間内の投稿数を数える"""
+    room = app.create_room("bench_agents")
+    scheduler_config = app.config["scheduler"]
+    scheduler_config["AGENT_INTERVAL"] = 0
+    scheduler_config["ROUND_INTERVAL"] = 0
+    start_counter = room.post_counter
+    started = time.perf_counter()
+    set_agents(app, room, agents)
+    time.sleep(duration)
+    set_agents(app, room, 0)
+    elapsed = time.perf_counter() - started
+    posts = [m for m in room.conversation if m["number"] >= start_counter]
+    errors = sum(1 for m in posts if m["text"].startswith("エラー:"))
+    posted = room.post_counter - start_counter
+    return {
+        "agents": agents,
+        "concurrency": app.config["conversation"].get("AGENT_CONCURRENCY", 1),
+        "duration_seconds": round(elapsed, 3),
+        "posts": posted,
+        "posts_per_minute": round(posted / elapsed * 60, 2),
+        "error_posts": errors
+    }
+
+def bench_summary(app, history):
+    """history 件の会話のまとめを作る時間 (初回と、1件追加した後の再計算)"""
+    room = app.create_room("bench_summary")
+    for i in range(history):
+        app.append_message(room, f"user{i % 5}", f"ベンチマーク用の投稿 {i} です。論点をひとつ挙げます。")
+    # 非同期保存の書き込みを済ませてから計る (要約が全件を読めるように)
+    app.persistence_writer.flush()
+    started = time.perf_counter()
+    app.generate_summary(room)
+    cold = time.perf_counter() - started
+    app.append_message(room, "user0", "追加の投稿です。")
+    started = time.perf_counter()
+    app.generate_summary(room)
+    warm = time.perf_counter() - started
+    return {"history": history, "cold_seconds": round(cold, 3), "incremental_seconds": round(warm, 3)}
+
+def bench_polling(app, pollers, duration, post_interval=0.1):
+    """N 並列で ETag 付きの差分取得を繰り返し、その間も一定間隔で投稿を続ける"""
+    from werkzeug.serving import make_server
+    room = app.create_room("bench_poll")
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/room/{room.room_id}/conversation_partial"
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+
+    def poll():
+        etag = None
+        while not stop.is_set():
+            req = urllib.request.Request(url, headers={"If-None-Match": etag} if etag else {})
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(req, timeout=10) as res:
+                    res.read()
+                    status = res.status
+                    etag = res.headers.get("ETag")
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except OSError:
+                status = "error"
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def post():
+        i = 0
+        while not stop.is_set():
+            app.append_message(room, "writer", f"ポーリング中の投稿 {i}")
+            i += 1
+            time.sleep(post_interval)
+
+    threads = [threading.Thread(target=poll, daemon=True) for _ in range(pollers)]
+    threads.append(threading.Thread(target=post, daemon=True))
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join(timeout=10)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    return {
+        "pollers": pollers,
+        "duration_seconds": round(elapsed, 3),
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / elapsed, 2),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        "statuses": statuses
+    }
+
+def bench_persistence(app, checkpoints):
+    """投稿を追加し続け、区間ごとの1件あたりの保存時間とストアのサイズを記録する"""
+    room = app.create_room("bench_persist")
+    store_dir = app.room_store_dir(room.room_id)
+    results = []
+    done = 0
+    for checkpoint in sorted(checkpoints):
+        started = time.perf_counter()
+        count = checkpoint - done
+        for i in range(count):
+            app.append_message(room, "user", f"保存コスト計測用の投稿 {done + i} です。")
+        # 非同期保存では append_message がすぐ戻るので、書き込みが終わるまでを計る
+        app.persistence_writer.flush()
+        elapsed = time.perf_counter() - started
+        done = checkpoint
+        results.append({
+            "history": checkpoint,
+            "append_mean_us": round(elapsed / max(1, count) * 1e6, 2),
+            "store_bytes": directory_size(store_dir)
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoChat ベンチマーク")
+    parser.add_argument("--agents", type=int, default=4)
+    parser.add_argument("--agent-concurrency", type=int, default=1)
+    parser.add_argument("--llm-slots", type=int, default=4)
+    parser.add_argument("--agent-duration", type=float, default=10)
+    parser.add_argument("--summary-history", type=int, default=500)
+    parser.add_argument("--pollers", type=int, default=16)
+    parser.add_argument("--poll-duration", type=float, default=5)
+    parser.add_argument("--history", type=int, nargs="+", default=[1000, 5000, 10000, 20000])
+    parser.add_argument("--latency", type=float, default=0.05, help="モックLLMの最初のトークンまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="モックLLMの生成速度")
+    parser.add_argument("--response-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-backends", type=int, default=1, help="起動するモックLLMサーバーの台数 (2以上で振り分けを使う)")
+    parser.add_argument("--stream", action="store_true", help="エージェントの応答をストリーミングで受け取る")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["agents", "summary", "polling", "persistence"])
+    parser.add_argument("--workdir", help="作業ディレクトリ (省略時は一時ディレクトリ)")
+    parser.add_argument("--output", help="結果のJSONを書き出すファイル")
+    args = parser.parse_args()
+
+    mocks = []
+    for i in range(max(1, args.llm_backends)):
+        settings = MockSettings(args.latency, args.tokens_per_second, args.response_tokens, args.error_rate, seed=i)
+        mocks.append((settings,) + start_server(settings))
+    base_url = mocks[0][2]
+
+    # アプリは作業ディレクトリの config.json / 会話ストアを使うので、専用のディレクトリで読み込む
+    workdir = args.workdir or tempfile.mkdtemp(prefix="autochat-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    import app
+
+    app.config["chat"].update(base_url=base_url, api_key="mock", model="mock", stream=args.stream)
+    if len(mocks) > 1:
+        app.config["chat"]["backends"] = [
+            {"name": f"mock{i + 1}", "base_url": url, "api_key": "mock", "model": "mock"}
+            for i, (_, _, url) in enumerate(mocks)
+        ]
+    app.config["conversation"]["AGENT_CONCURRENCY"] = args.agent_concurrency
+    app.config["scheduler"]["LLM_SLOTS"] = args.llm_slots
+    app.save_config()
+    app.config_version += 1
+    # 自動要約は summary で個別に計測する
+    app.AUTO_SUMMARY_INTERVAL = 10 ** 9
+
+    results = {}
+    if "agents" not in args.skip:
+        results["agents"] = bench_agents(app, args.agents, args.agent_duration)
+    if "summary" not in args.skip:
+        results["summary"] = bench_summary(app, args.summary_history)
+    if "polling" not in args.skip:
+        results["polling"] = bench_polling(app, args.pollers, args.poll_duration)
+    if "persistence" not in args.skip:
+        results["persistence"] = bench_persistence(app, args.history)
+    for _, server, _ in mocks:
+        server.shutdown()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "workdir": workdir,
+        "settings": vars(args),
+        "mock_llm": {
+            "requests": sum(m[0].requests for m in mocks),
+            "injected_errors": sum(m[0].errors for m in mocks),
+            "requests_per_backend": [m[0].requests for m in mocks]
+        },
+        "results": results
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+ベンチマーク用の OpenAI 互換モックサーバー (/v1/chat/completions と、ヘルスチェック用の /v1/models)。
+
+LLM の代わりに、指定した待ち時間・生成速度で固定の文章を返します。エラーの注入もできます。
+単体でも起動できます:
+
+    python bench/mock_openai_server.py --port 8001 --latency 0.2 --tokens-per-second 50
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_TEXT = "なるほど、その意見には一理あると思います。ただ別の見方もできそうです。"
+
+class MockSettings:
+    def __init__(self, latency=0.1, tokens_per_second=0, response_tokens=60, error_rate=0.0, seed=None):
+        self.latency = latency                      # 最初のトークンまでの秒数
+        self.tokens_per_second = tokens_per_second  # 0 なら生成時間なし
+        self.response_tokens = response_tokens      # 応答の長さ (1文字=1トークンとして扱う)
+        self.error_rate = error_rate                # この確率で 500 を返す
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def next_request(self):
+        """リクエスト数を数え、エラーを注入するかどうかを返す"""
+        with self.lock:
+            self.requests += 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return fail
+
+def response_text(length):
+    return (SAMPLE_TEXT * (length // len(SAMPLE_TEXT) + 1))[:length]
+
+def make_handler(settings):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if not self.path.rstrip("/").endswith("/models"):
+                self._send_json(404, {"error": {"message": "not found"}})
+                return
+            self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": "not found"}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            time.sleep(settings.latency)
+            if settings.next_request():
+                self._send_json(500, {"error": {"message": "injected error", "type": "server_error"}})
+                return
+            text = response_text(settings.response_tokens)
+            prompt_tokens = sum(len(m.get("content") or "") for m in request.get("messages", []))
+            delay = 1.0 / settings.tokens_per_second if settings.tokens_per_second else 0
+            model = request.get("model", "mock")
+            created = int(time.time())
+            if request.get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for i in range(0, len(text), 4):
+                    chunk = {
+                        "id": "mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [{"index": 0, "delta": {"content": text[i:i + 4]}, "finish_reason": None}]
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(delay * 4)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+                return
+            time.sleep(delay * len(text))
+            self._send_json(200, {
+                "id": "mock", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(text),
+                          "total_tokens": prompt_tokens + len(text)}
+            })
+    return Handler
+
+def start_server(settings, host="127.0.0.1", port=0):
+    """バックグラウンドでサーバーを起動し、(server, base_url) を返す"""
+    server = ThreadingHTTPServer((host, port), make_handler(settings))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI互換のモックLLMサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.1, help="最初のトークンまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="生成速度 (0 で待ちなし)")
+    parser.add_argument("--response-tokens", type=int, default=60, help="応答の長さ")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500を返す確率")
+    args = parser.parse_args()
+    settings = MockSettings(args.latency, args.tokens_per_second, args.response_tokens, args.error_rate)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(settings))
+    print(f"モックLLMサーバー: http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""
+app.py は読み込み時にカレントディレクトリの config.json・会話ストアを使うため、
+テストは一時ディレクトリで別プロセスとして動かし、最後の行のJSONを結果として受け取る。
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def run_app(tmp_path):
+    """run_app(script, config_update=None) で、既定設定に config_update を重ねた状態の app を動かす"""
+    # 1回目の起動で既定の config.json を作らせる
+    subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {APP_DIR!r}); import app"],
+                   cwd=tmp_path, capture_output=True, check=True, timeout=60)
+
+    def run(script, config_update=None):
+        config_path = tmp_path / "config.json"
+        config = json.loads(config_path.read_text(encoding="utf-8"))
+        for section, values in (config_update or {}).items():
+            config.setdefault(section, {}).update(values)
+        config_path.write_text(json.dumps(config, ensure_ascii=False), encoding="utf-8")
+        source = f"import sys\nsys.path.insert(0, {APP_DIR!r})\nimport app\n" + script
+        result = subprocess.run([sys.executable, "-c", source], cwd=tmp_path, capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    return run
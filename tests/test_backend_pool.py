@@ -0,0 +1,63 @@
+"""LLMサーバーの振り分けの確認"""
+
+RECONFIGURE = """
+import json
+pool = app.BackendPool({"backends": [
+    {"name": "a", "base_url": "http://a/v1"},
+    {"name": "b", "base_url": "http://b/v1"}
+], "HEALTH_CHECK_INTERVAL": 0, "FAILURE_THRESHOLD": 1})
+a = pool.acquire(backend="a")
+pool.acquire(backend="b")
+pool.release(pool.backends[1], ok=False)
+pool.configure({"backends": [
+    {"name": "a", "base_url": "http://a/v1", "weight": 2},
+    {"name": "b", "base_url": "http://b/v1"},
+    {"name": "c", "base_url": "http://c/v1"}
+], "HEALTH_CHECK_INTERVAL": 0, "FAILURE_THRESHOLD": 1})
+print(json.dumps({
+    "same": pool.backends[0] is a,
+    "status": [[s["name"], s["outstanding"], s["weight"], s["healthy"]] for s in pool.status()]
+}))
+"""
+
+def test_reconfigure_keeps_backend_state(run_app):
+    """設定の再読み込みで、残ったサーバーの実行中の数と切り離しが引き継がれる"""
+    assert run_app(RECONFIGURE) == {
+        "same": True,
+        "status": [["a", 1, 2.0, True], ["b", 0, 1.0, False], ["c", 0, 1.0, True]]
+    }
+
+CACHE_KEY = """
+import json
+from types import SimpleNamespace
+
+class FakeClient:
+    def __init__(self, reply):
+        self.reply = reply
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+    def create(self, model, messages, timeout):
+        message = SimpleNamespace(content=f"{self.reply}:{model}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+app.config["chat"]["backends"] = [
+    {"name": "a", "base_url": "http://a/v1", "model": "m1", "max_concurrency": 1},
+    {"name": "b", "base_url": "http://b/v1", "model": "m2"}
+]
+app.config["chat"]["HEALTH_CHECK_INTERVAL"] = 0
+chat = app.Chat()
+chat.pool.backends[0].client = FakeClient("a")
+chat.pool.backends[1].client = FakeClient("b")
+msgs = [{"role": "user", "content": "要約して"}]
+first = chat.complete(msgs, use_cache=True, agent={"backend": "a"})
+# モデルの違うサーバーの応答は使わない
+second = chat.complete(msgs, use_cache=True, agent={"backend": "b"})
+# サーバー a が埋まっていても、キャッシュにあれば待たずに返し、送信数も増やさない
+held = chat.pool.acquire(backend="a")
+sent = [b.sent for b in chat.pool.backends]
+third = chat.complete(msgs, use_cache=True, agent={"backend": "a"})
+print(json.dumps([first, second, third, sent == [b.sent for b in chat.pool.backends]]))
+"""
+
+def test_cache_key_uses_backend_model(run_app):
+    """既定のモデルが違うサーバーの応答を取り違えず、キャッシュにあればサーバーを確保しない"""
+    assert run_app(CACHE_KEY) == ["a:m1", "b:m2", "a:m1", True]
@@ -0,0 +1,38 @@
+"""会話履歴のNDJSONエクスポート/インポートの確認"""
+
+EXPORT_IMPORT = """
+import json
+source = app.rooms[app.DEFAULT_ROOM_ID]
+app.import_thread_config_json(source, json.dumps({
+    "title": "移行テスト",
+    "agents": [{"id": 1, "name": "Alice", "personality": "明るい"}, {"id": 5, "name": "Bob", "personality": "冷静"}]
+}))
+source.next_agent_id = 9  # 削除済みのエージェントがいた場合
+app.append_message(source, "Alice", "こんにちは")
+app.append_message(source, "Bob", "どうも", reply_to="Alice")
+data = b"".join(app.export_conversation_ndjson(source))
+
+target = app.create_room("target")
+app.append_message(target, "user", "既存の投稿")
+count = app.import_conversation_ndjson(target, data.splitlines())
+print(json.dumps({
+    "count": count,
+    "posts": [[m.number, m.agent, m.reply_to, m.text] for m in target.conversation],
+    "post_counter": target.post_counter,
+    "title": target.thread_config["title"],
+    "next_agent_id": target.next_agent_id
+}, ensure_ascii=False))
+"""
+
+def test_export_import_keeps_reply_names(run_app):
+    """取り込んだ投稿は後ろに番号を振り直し、返信先の名前と次のエージェントIDを保つ"""
+    data = run_app(EXPORT_IMPORT)
+    assert data["count"] == 2
+    assert data["posts"] == [
+        [1, "user", None, "既存の投稿"],
+        [2, "Alice", None, "こんにちは"],
+        [3, "Bob", "Alice", "どうも"]
+    ]
+    assert data["post_counter"] == 4
+    assert data["title"] == "移行テスト"
+    assert data["next_agent_id"] == 9
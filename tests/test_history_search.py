@@ -0,0 +1,36 @@
+"""過去ログ検索の確認"""
+
+REPLY_FILTER = """
+import json
+room = app.rooms[app.DEFAULT_ROOM_ID]
+app.append_message(room, "Alice", "はじめまして")
+app.append_message(room, "Bob", "よろしく", reply_to="Alice")
+app.append_message(room, "Carol", "こんばんは", reply_to="Bob")
+app.persistence_writer.flush()
+client = app.app.test_client()
+response = client.get("/history", query_string={"reply_to": "Alice", "format": "json"})
+print(json.dumps([[m["agent"], m["reply_to"]] for m in response.get_json()["messages"]], ensure_ascii=False))
+"""
+
+def test_history_filters_by_reply_name(run_app):
+    """返信先は名前で絞り込める"""
+    assert run_app(REPLY_FILTER) == [["Bob", "Alice"]]
+
+REBUILD = """
+import json
+room = app.rooms[app.DEFAULT_ROOM_ID]
+app.append_message(room, "Alice", "はじめまして")
+app.append_message(room, "Bob", "よろしく")
+app.persistence_writer.flush()
+with app.history_index.lock, app.history_index.conn:
+    app.history_index.conn.execute("DELETE FROM history WHERE room_id = ?", (room.room_id,))
+client = app.app.test_client()
+before = client.get("/history", query_string={"format": "json"}).get_json()["messages"]
+client.post("/rebuild_history_index")
+after = client.get("/history", query_string={"format": "json"}).get_json()["messages"]
+print(json.dumps([len(before), [m["agent"] for m in after]]))
+"""
+
+def test_rebuild_history_index_from_log(run_app):
+    """欠けたインデックスを会話ログから作り直せる"""
+    assert run_app(REBUILD) == [0, ["Bob", "Alice"]]
@@ -0,0 +1,17 @@
+"""投稿番号での読み出し (/posts) の確認"""
+
+UNFLUSHED = """
+import json
+room = app.rooms[app.DEFAULT_ROOM_ID]
+app.AUTO_SUMMARY_INTERVAL = 10 ** 6  # 自動要約は動かさない
+for i in range(5):
+    app.append_message(room, "Alice", f"投稿{i + 1}")
+client = app.app.test_client()
+messages = client.get("/posts/1-5").get_json()["messages"]
+print(json.dumps([[m["number"], m["text"]] for m in messages], ensure_ascii=False))
+"""
+
+def test_posts_include_posts_not_yet_written(run_app):
+    """非同期保存で書き込み待ちの直近の投稿も返す"""
+    result = run_app(UNFLUSHED, {"persistence": {"MODE": "async", "FLUSH_INTERVAL": 2}})
+    assert result == [[i, f"投稿{i}"] for i in range(1, 6)]
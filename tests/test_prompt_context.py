@@ -0,0 +1,18 @@
+"""プロンプトに載せる直近の書き込みの確認"""
+
+BUDGET_CONTEXT = """
+import json
+room = app.rooms[app.DEFAULT_ROOM_ID]
+app.AUTO_SUMMARY_INTERVAL = 10 ** 6  # 自動要約は動かさない
+agent = {"id": 1, "name": "Alice", "personality": "明るい"}
+for i in range(40):
+    app.append_message(room, "Bob", f"短い投稿{i + 1}")
+messages = app.build_agent_messages(room, agent)
+batch = app.build_batch_messages(room, [agent, {"id": 2, "name": "Carol", "personality": "静か"}])
+print(json.dumps([messages[-1]["content"].count("短い投稿"), batch[-1]["content"].count("短い投稿")]))
+"""
+
+def test_token_budget_is_not_capped_by_context_window(run_app):
+    """トークン予算に収まるなら CONTEXT_WINDOW 件を超えて載せる"""
+    result = run_app(BUDGET_CONTEXT, {"conversation": {"CONTEXT_WINDOW": 10, "CONTEXT_TOKEN_BUDGET": 4000}})
+    assert result == [40, 40]
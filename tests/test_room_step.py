@@ -0,0 +1,40 @@
+"""ユーザ投稿への返信エージェント選びの確認"""
+
+PICK_REPLY = """
+import json
+room = app.Room("test")
+agents = [{"id": 1, "name": "Al", "personality": "明るい"}, {"id": 2, "name": "Alice", "personality": "静か"}]
+room.name_matcher.set_agents(agents)
+picked = [app.pick_reply_agent(room, agents, {"text": text}) for text in ("@Alice どう思う？", "@Al さん", "こんにちは")]
+print(json.dumps([agent and agent["name"] for agent in picked]))
+"""
+
+def test_pick_reply_agent_prefers_longest_name(run_app):
+    """「@Alice」は「Al」ではなく「Alice」への指名として扱う"""
+    assert run_app(PICK_REPLY) == ["Alice", "Al", None]
+
+BATCH_COOLDOWN = """
+import json
+room = app.rooms[app.DEFAULT_ROOM_ID]
+app.AUTO_SUMMARY_INTERVAL = 10 ** 6  # 自動要約は動かさない
+agents = [{"id": 1, "name": "Alice", "personality": "明るい"}, {"id": 2, "name": "Bob", "personality": "静か"}]
+app.update_thread_config(room, lambda room: room.thread_config.update(agents=agents))
+kinds = []
+class FakeChat:
+    def complete(self, msgs, use_cache=False, kind="agent", agent=None):
+        kinds.append(kind)
+        return "配列ではない応答"
+app.get_chat = lambda: FakeChat()
+for _ in range(3):
+    app.run_batched_round(room, list(agents))
+disabled = room.batch_disabled_until > app.time.time()
+kinds.clear()
+room.agent_cursor = 0
+app.run_room_step(room)
+print(json.dumps([disabled, kinds]))
+"""
+
+def test_batch_turns_pause_after_repeated_parse_failures(run_app):
+    """一括生成の応答が続けて読めなければ、しばらく1人ずつ生成する"""
+    result = run_app(BATCH_COOLDOWN, {"conversation": {"BATCH_TURNS": True, "BATCH_FAILURE_THRESHOLD": 3}})
+    assert result == [True, ["agent"]]
@@ -0,0 +1,32 @@
+"""共有バックエンド (SQLite) のログ書き込みの確認"""
+
+FLUSH_SPANNING_CLEAR = """
+import json
+backend = app.state_backend
+backend.renew_lease = lambda: None
+backend.is_leader = False
+room = app.rooms[app.DEFAULT_ROOM_ID]
+app.append_message(room, "user", "before clear 1")
+app.clear_messages(room)
+app.append_message(room, "user", "after clear 1")
+app.append_message(room, "user", "after clear 2")
+backend.sync()
+
+backend.is_leader = True
+backend.flush_logs()
+store = backend.stores[room.room_id]
+logged_seq = backend.conn.execute("SELECT logged_seq FROM rooms WHERE room_id = ?", (room.room_id,)).fetchone()[0]
+print(json.dumps({
+    "log": [m["text"] for m in store.iter_messages()],
+    "indexed": [m["text"] for m in app.history_index.search(room.room_id, "clear")[0]],
+    "logged_seq": logged_seq,
+    "last_seq": backend.last_seq
+}, ensure_ascii=False))
+"""
+
+def test_flush_logs_spanning_clear(run_app):
+    """クリアをまたぐ書き込みでも、クリア後の投稿がログと検索インデックスに残る"""
+    data = run_app(FLUSH_SPANNING_CLEAR, {"state_backend": {"type": "sqlite", "path": "state.db"}})
+    assert data["log"] == ["before clear 1", "after clear 1", "after clear 2"]
+    assert sorted(data["indexed"]) == ["after clear 1", "after clear 2", "before clear 1"]
+    assert data["logged_seq"] == data["last_seq"]
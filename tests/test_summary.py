@@ -0,0 +1,58 @@
+"""階層的な要約の確認"""
+
+INCREMENTAL = """
+import json
+room = app.rooms[app.DEFAULT_ROOM_ID]
+app.AUTO_SUMMARY_INTERVAL = 10 ** 6  # 自動要約は動かさない
+prompts = []
+def fake_chat(prompt, system_override=None):
+    prompts.append(prompt)
+    return f"要約{len(prompts)}"
+app.get_chat = lambda: fake_chat
+reads = []
+read_conversation = app.read_conversation
+def recording_read(room, first, last):
+    reads.append([first, last])
+    return read_conversation(room, first, last)
+app.read_conversation = recording_read
+
+for i in range(25):
+    app.append_message(room, "Alice", f"投稿{i + 1}")
+app.generate_summary(room)
+first_calls = len(prompts)
+for i in range(25, 35):
+    app.append_message(room, "Bob", f"投稿{i + 1}")
+app.generate_summary(room)
+leaves = [p for p in prompts[first_calls:] if p.startswith("以下は会話の一部です")]
+print(json.dumps({
+    "reads": reads,
+    "ranges": [[first, last] for first, last, _ in room.summary_progress[2]],
+    "new_leaves": [p.count("投稿") for p in leaves]
+}))
+"""
+
+def test_summary_reads_from_last_finalized_chunk(run_app):
+    """2回目の要約は確定済みの区切りの次の投稿から読み、新しい区切りだけを要約する"""
+    result = run_app(INCREMENTAL, {"conversation": {"SUMMARY_CHUNK_SIZE": 10, "SUMMARY_CHUNK_TOKENS": 0}})
+    assert result["reads"] == [[1, 25], [21, 35]]
+    assert result["ranges"] == [[1, 10], [11, 20], [21, 30]]
+    assert result["new_leaves"] == [10, 5]
+
+UNFLUSHED = """
+import json
+room = app.rooms[app.DEFAULT_ROOM_ID]
+app.AUTO_SUMMARY_INTERVAL = 10 ** 6  # 自動要約は動かさない
+app.get_chat = lambda: (lambda prompt, system_override=None: "要約")
+for i in range(200):
+    app.append_message(room, "Alice", f"投稿{i + 1}")
+app.generate_summary(room)
+print(json.dumps([[first, last] for first, last, _ in room.summary_progress[2]]))
+"""
+
+def test_summary_reads_posts_still_being_written(run_app):
+    """非同期保存で書き込み待ちの投稿も、メモリ上の会話より古いものまで要約に含める"""
+    result = run_app(UNFLUSHED, {
+        "conversation": {"SUMMARY_CHUNK_SIZE": 50, "SUMMARY_CHUNK_TOKENS": 0, "MAX_CONVERSATION_LENGTH": 100},
+        "persistence": {"MODE": "async", "FLUSH_INTERVAL": 1}
+    })
+    assert result == [[1, 50], [51, 100], [101, 150], [151, 200]]